@@ -0,0 +1,399 @@
+# Copyright (c) 2013 Galah Group LLC
+# Copyright (c) 2013 Other contributers as noted in the CONTRIBUTERS file
+#
+# This file is part of galah-apiclient.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This module handles the agent, a long-running process that holds a logged in
+session so that other invocations of the API client don't have to.
+
+The agent listens on a Unix domain socket (see the ``agent-socket-path``
+option). The protocol is one JSON object per line. The client sends a single
+request:
+
+.. code-block:: javascript
+
+    {"command": "find_user", "args": ["jsull"], "kwargs": {},
+     "cwd": "/home/jsull", "host": ["https://galah.edu"], "user": null}
+
+and the agent replies with any number of ``{"output": text}`` and
+``{"log": text}`` objects as the command runs, followed by a final
+``{"exit_status": n}``. If the agent won't execute the command (because it is
+logged into a different server or as a different user) it replies with
+``{"declined": reason}`` and the client executes the command itself.
+
+A request of ``{"stop": true}`` stops the agent.
+
+"""
+
+import os
+import sys
+import errno
+import socket
+import threading
+
+import ui
+import utils
+import config
+import hostpool
+
+import logging
+logger = logging.getLogger("apiclient.agent")
+
+def _encode(value):
+    """
+    Converts the unicode strings JSON gives us back into the byte strings the
+    rest of the client uses.
+
+    """
+
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+
+    return value
+
+class _FrameWriter(object):
+    """
+    A file-like object that sends everything written to it to the client as
+    ``{key: text}`` lines.
+
+    """
+
+    # Responses are encoded with this when they are printed to us.
+    encoding = "utf-8"
+
+    def __init__(self, wfile, key, lock):
+        self.wfile = wfile
+        self.key = key
+        self.lock = lock
+
+    def write(self, text):
+        if not text:
+            return
+
+        if isinstance(text, str):
+            text = text.decode("utf-8", "replace")
+
+        with self.lock:
+            self.wfile.write(utils.to_json({self.key: text}) + "\n")
+
+    def flush(self):
+        with self.lock:
+            self.wfile.flush()
+
+class Agent(object):
+    """
+    Executes commands sent to it over a Unix domain socket using a single,
+    shared session.
+
+    :ivar session: The :class:`communicate.APIClientSession` commands are
+            executed with.
+    :ivar socket_path: Where the agent is listening.
+
+    """
+
+    def __init__(self, session, socket_path):
+        self.session = session
+        self.socket_path = socket_path
+        self.server = None
+
+    def serve(self):
+        """
+        Listens for and executes commands until :meth:`stop` is called or
+        the agent is interrupted.
+
+        """
+
+        import SocketServer
+
+        agent = self
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                agent._handle(self.rfile, self.wfile)
+
+            def finish(self):
+                try:
+                    SocketServer.StreamRequestHandler.finish(self)
+                except socket.error:
+                    # The client went away before reading everything.
+                    pass
+
+        class Server(SocketServer.ThreadingUnixStreamServer):
+            daemon_threads = True
+
+        if is_running(self.socket_path):
+            logger.critical(
+                "An agent is already listening at %s.", self.socket_path
+            )
+            sys.exit(1)
+        elif os.path.exists(self.socket_path):
+            logger.debug("Removing stale socket at %s.", self.socket_path)
+            os.remove(self.socket_path)
+
+        utils.prepare_directory(os.path.dirname(self.socket_path))
+
+        # Only the user running the agent may connect to it, as it can act
+        # on their behalf.
+        old_umask = os.umask(0o177)
+        try:
+            self.server = Server(self.socket_path, Handler)
+        except socket.error:
+            logger.critical(
+                "Could not listen at %s.", self.socket_path,
+                exc_info = sys.exc_info()
+            )
+            sys.exit(1)
+        finally:
+            os.umask(old_umask)
+
+        logger.info(
+            "Agent listening at %s. Press Ctrl+C to stop it.",
+            self.socket_path
+        )
+
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+        logger.info("Agent stopped.")
+
+    def stop(self):
+        """
+        Makes :meth:`serve` return. Must not be called from the thread that
+        is running :meth:`serve`.
+
+        """
+
+        self.server.shutdown()
+
+    def _handle(self, rfile, wfile):
+        lock = threading.Lock()
+        out = _FrameWriter(wfile, "output", lock)
+
+        def reply(**kwargs):
+            with lock:
+                wfile.write(utils.to_json(kwargs) + "\n")
+                wfile.flush()
+
+        try:
+            request = utils.json_module().loads(rfile.readline())
+            if not isinstance(request, dict):
+                raise ValueError("request must be an object")
+        except ValueError as e:
+            logger.warn("Received an invalid request: %s.", str(e))
+            return
+
+        try:
+            if request.get("stop"):
+                reply(exit_status = 0)
+                threading.Thread(target = self.stop).start()
+                return
+
+            reason = self._should_decline(request)
+            if reason is not None:
+                reply(declined = reason)
+                return
+
+            exit_status, _ = ui.run_redirected(
+                lambda: self._execute(request),
+                out, _FrameWriter(wfile, "log", lock)
+            )
+
+            reply(exit_status = exit_status)
+        except socket.error as e:
+            # The client went away, there's no one to tell.
+            if e.errno not in (errno.EPIPE, errno.ECONNRESET):
+                raise
+
+    def _should_decline(self, request):
+        """
+        Returns why the agent won't execute a request, or ``None`` if it
+        will.
+
+        """
+
+        hosts = hostpool.parse_hosts(config.CONFIG["host"])
+        if request.get("host") != hosts:
+            return "the agent is connected to %s" % (", ".join(hosts), )
+
+        user = request.get("user")
+        if user is not None and user != self.session.user:
+            return "the agent is logged in as %s" % (self.session.user, )
+
+        return None
+
+    def _execute(self, request):
+        command = _encode(request.get("command"))
+        args = [_encode(i) for i in request.get("args", [])]
+        kwargs = dict(
+            (_encode(k), _encode(v))
+                for k, v in request.get("kwargs", {}).items()
+        )
+
+        self.session.revalidate_api_info()
+
+        # Paths the user gave are relative to where they ran the client, not
+        # to wherever the agent happens to be.
+        func = self.session.api_info.get(command)
+        if func is not None:
+            try:
+                kwargs = func.resolve_arguments(*args, **kwargs)
+                args = []
+            except TypeError:
+                # Let the session report the problem.
+                pass
+            else:
+                for i in func.params:
+                    if i.param_type is file:
+                        kwargs[i.name] = os.path.join(
+                            _encode(request["cwd"]), kwargs[i.name]
+                        )
+
+        self.session.call(command, *args, **kwargs)
+
+def is_running(socket_path):
+    """
+    Returns ``True`` iff an agent is listening at ``socket_path``.
+
+    """
+
+    sock = _connect(socket_path)
+    if sock is None:
+        return False
+
+    sock.close()
+    return True
+
+def _connect(socket_path):
+    if not os.path.exists(socket_path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        return None
+
+    return sock
+
+def _send(socket_path, request):
+    """
+    Sends a request to the agent and returns an iterator over the objects it
+    replies with, or ``None`` if no agent is listening.
+
+    """
+
+    sock = _connect(socket_path)
+    if sock is None:
+        return None
+
+    json = utils.json_module()
+
+    def replies():
+        try:
+            sock.sendall(utils.to_json(request) + "\n")
+            for line in sock.makefile("rb"):
+                yield json.loads(line)
+        finally:
+            sock.close()
+
+    return replies()
+
+def call(socket_path, command, args, kwargs):
+    """
+    Has the agent listening at ``socket_path`` execute a command, printing its
+    output and log messages as they arrive.
+
+    :returns: The command's exit status, or ``None`` if there is no agent or
+            it won't execute the command, in which case nothing has been
+            printed.
+
+    """
+
+    replies = _send(socket_path, {
+        "command": command,
+        "args": args,
+        "kwargs": kwargs,
+        "cwd": os.getcwd(),
+        "host": hostpool.parse_hosts(config.CONFIG["host"]),
+        "user": config.CONFIG.get("user")
+    })
+    if replies is None:
+        return None
+
+    try:
+        for reply in replies:
+            if "output" in reply:
+                sys.stdout.write(reply["output"].encode(
+                    sys.stdout.encoding or "utf-8", "replace"
+                ))
+                sys.stdout.flush()
+            elif "log" in reply:
+                sys.stderr.write(reply["log"].encode(
+                    sys.stderr.encoding or "utf-8", "replace"
+                ))
+            elif "declined" in reply:
+                logger.debug(
+                    "Agent declined to execute the command because %s.",
+                    reply["declined"]
+                )
+                return None
+            elif "exit_status" in reply:
+                return reply["exit_status"]
+    except socket.error:
+        logger.critical(
+            "Lost the connection to the agent.", exc_info = sys.exc_info()
+        )
+        return 1
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+
+        # Our output was closed early, see communicate._print_text.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        return 128 + 13
+    except ValueError:
+        logger.critical(
+            "Received an invalid reply from the agent.",
+            exc_info = sys.exc_info()
+        )
+        return 1
+
+    logger.critical("The agent stopped before the command finished.")
+    return 1
+
+def stop(socket_path):
+    """
+    Stops the agent listening at ``socket_path``.
+
+    :returns: ``True`` if there was an agent to stop, ``False`` otherwise.
+
+    """
+
+    replies = _send(socket_path, {"stop": True})
+    if replies is None:
+        return False
+
+    for _ in replies:
+        pass
+
+    return True
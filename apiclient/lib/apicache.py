@@ -0,0 +1,196 @@
+# Copyright (c) 2013 Galah Group LLC
+# Copyright (c) 2013 Other contributers as noted in the CONTRIBUTERS file
+#
+# This file is part of galah-apiclient.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This module handles the compiled copy of the API info cache, along with the
+metadata used to check whether the cache is still up to date. The same
+snapshots are used to avoid parsing the configuration file on every run.
+
+Parsing the JSON API info and building a :class:`function.Function` for every
+command is most of what the client does when it starts up. To avoid this, a
+snapshot of :func:`function.compile_api_info`'s output is saved with
+``marshal`` next to the API info file, and is used instead of the JSON
+whenever the JSON hasn't changed since the snapshot was made.
+
+"""
+
+import os
+import sys
+import marshal
+import hashlib
+
+import utils
+import function
+
+import logging
+logger = logging.getLogger("apiclient.apicache")
+
+#: Appended to the path of the API info file to get the path of the snapshot.
+SUFFIX = ".compiled"
+
+#: Incremented whenever the layout of the snapshot changes.
+FORMAT_VERSION = 1
+
+def _header(stat, digest):
+    return (
+        FORMAT_VERSION, sys.version_info[:2], stat.st_size, stat.st_mtime,
+        digest
+    )
+
+def load_snapshot(raw_path, snapshot_path):
+    """
+    Loads a snapshot of data that was derived from the file at ``raw_path``,
+    as saved by :func:`save_snapshot`.
+
+    The snapshot is used if the file has the same size and modification time
+    it had when the snapshot was made. If only the modification time differs,
+    the file is hashed and the snapshot is used if the contents are unchanged.
+
+    :returns: The data that was saved, or ``None`` if there is no usable
+            snapshot.
+
+    """
+
+    if not os.path.isfile(snapshot_path):
+        return None
+
+    try:
+        stat = os.stat(raw_path)
+        with open(snapshot_path, "rb") as f:
+            header = marshal.load(f)
+            if header[:2] != (FORMAT_VERSION, sys.version_info[:2]):
+                logger.debug("Snapshot at %s is out of date.", snapshot_path)
+                return None
+
+            size, mtime, digest = header[2:]
+            if size != stat.st_size:
+                logger.debug("%s has changed since its snapshot.", raw_path)
+                return None
+
+            if mtime != stat.st_mtime:
+                with open(raw_path, "rb") as raw_file:
+                    if hashlib.sha1(raw_file.read()).hexdigest() != digest:
+                        logger.debug(
+                            "%s has changed since its snapshot.", raw_path
+                        )
+                        return None
+
+            return marshal.load(f)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        logger.debug(
+            "Could not load snapshot at %s.", snapshot_path, exc_info = True
+        )
+        return None
+
+def save_snapshot(raw_path, raw, data, snapshot_path):
+    """
+    Saves a snapshot of ``data``, which was derived from the file at
+    ``raw_path``. The file should contain ``raw``.
+
+    :param data: Anything ``marshal`` can serialize.
+
+    """
+
+    temp_path = snapshot_path + ".tmp"
+
+    try:
+        header = _header(os.stat(raw_path), hashlib.sha1(raw).hexdigest())
+        with open(temp_path, "wb") as f:
+            marshal.dump(header, f)
+            marshal.dump(data, f)
+        os.rename(temp_path, snapshot_path)
+    except (IOError, OSError, ValueError):
+        logger.debug(
+            "Could not save snapshot to %s.", snapshot_path, exc_info = True
+        )
+
+def load(raw_path):
+    """
+    Loads the snapshot of the API info file at ``raw_path``.
+
+    :returns: A :class:`function.FunctionIndex`, or ``None`` if there is no
+            usable snapshot.
+
+    """
+
+    compiled = load_snapshot(raw_path, raw_path + SUFFIX)
+    if not isinstance(compiled, dict):
+        return None
+
+    return function.FunctionIndex(compiled)
+
+def save(raw_path, raw, compiled):
+    """
+    Saves a snapshot of the API info file at ``raw_path``, which should
+    contain ``raw`` and have already been written.
+
+    :param compiled: A dictionary as returned by
+            :func:`function.compile_api_info`.
+
+    """
+
+    save_snapshot(raw_path, raw, compiled, raw_path + SUFFIX)
+
+#: Appended to the path of the API info file to get the path of the file
+#: recording when it was last checked against the server.
+META_SUFFIX = ".meta"
+
+def load_meta(raw_path):
+    """
+    Loads what was recorded by :func:`save_meta`.
+
+    :returns: A dictionary, which is empty if nothing could be loaded.
+
+    """
+
+    meta_path = raw_path + META_SUFFIX
+    if not os.path.isfile(meta_path):
+        return {}
+
+    try:
+        with open(meta_path, "rb") as f:
+            meta = utils.json_module().load(f)
+    except (IOError, ValueError):
+        logger.debug(
+            "Could not load API info metadata at %s.", meta_path,
+            exc_info = True
+        )
+        return {}
+
+    return meta if isinstance(meta, dict) else {}
+
+def save_meta(raw_path, meta):
+    """
+    Records details about the API info file at ``raw_path``, such as its ETag
+    and when it was last checked against the server.
+
+    :param meta: A dictionary that can be serialized to JSON.
+
+    """
+
+    meta_path = raw_path + META_SUFFIX
+    temp_path = meta_path + ".tmp"
+
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(utils.to_json(meta))
+        os.rename(temp_path, meta_path)
+    except (IOError, OSError):
+        logger.warn(
+            "Could not save API info metadata to %s.", meta_path,
+            exc_info = True
+        )
@@ -0,0 +1,246 @@
+# Copyright (c) 2013 Galah Group LLC
+# Copyright (c) 2013 Other contributers as noted in the CONTRIBUTERS file
+#
+# This file is part of galah-apiclient.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This module handles executing many API commands over a single session.
+
+"""
+
+import sys
+import shlex
+import multiprocessing.pool
+
+import ui
+import pretty
+import downloads
+import ratelimit
+import retry
+
+import logging
+logger = logging.getLogger("apiclient.batch")
+
+class BatchCommand:
+    """
+    A single command to be executed as part of a batch.
+
+    :ivar label: A short string identifying the command in the output, usually
+            the line number it came from.
+    :ivar raw: The command as the user typed it.
+    :ivar args: The command split up into words, just like how bash does it.
+    :ivar output: Everything the command printed, including any log messages.
+            ``None`` until the command has been executed.
+    :ivar exit_status: ``0`` if the command succeeded, otherwise a non-zero
+            integer. ``None`` until the command has been executed.
+
+    """
+
+    def __init__(self, label, raw, args):
+        self.label = label
+        self.raw = raw
+        self.args = args
+        self.output = None
+        self.exit_status = None
+
+    @property
+    def succeeded(self):
+        return self.exit_status == 0
+
+    def __str__(self):
+        return "[%s] %s" % (self.label, self.raw)
+
+def read_commands(f):
+    """
+    Reads commands from a file, one command per line. Blank lines and lines
+    starting with ``#`` are ignored.
+
+    :param f: A file object to read from.
+    :returns: A list of :class:`BatchCommand` objects.
+
+    """
+
+    commands = []
+    for line_number, line in enumerate(f, 1):
+        raw = line.strip()
+        if not raw or raw.startswith("#"):
+            continue
+
+        try:
+            args = shlex.split(raw)
+        except ValueError as e:
+            logger.critical(
+                "Could not parse line %d of batch file: %s.", line_number,
+                str(e)
+            )
+            sys.exit(1)
+
+        commands.append(BatchCommand(str(line_number), raw, args))
+
+    return commands
+
+def run_command(session, command):
+    """
+    Executes a single command and records its result.
+
+    Anything the command prints or logs is captured and stored in
+    ``command.output`` rather than being written to the terminal.
+
+    :param session: The :class:`communicate.APIClientSession` to use.
+    :param command: The :class:`BatchCommand` to execute.
+    :returns: ``command``
+
+    """
+
+    def execute():
+        command_args, command_kwargs = ui.parse_raw_args(command.args[1:])
+        session.call(command.args[0], *command_args, **command_kwargs)
+
+    command.exit_status, command.output, _ = ui.run_captured(execute)
+
+    return command
+
+def run_commands(session, commands, jobs, on_finished = None):
+    """
+    Executes a number of commands concurrently.
+
+    :param session: The :class:`communicate.APIClientSession` to use.
+    :param commands: A list of :class:`BatchCommand` objects.
+    :param jobs: The maximum number of commands to execute at once.
+    :param on_finished: A function that will be called with each command as
+            soon as it has been executed, from the thread that executed it.
+    :returns: An iterator that yields each command after it has been executed.
+            Commands are yielded in the same order they were given in,
+            regardless of the order they finished in.
+
+    """
+
+    def execute(command):
+        run_command(session, command)
+        if on_finished is not None:
+            on_finished(command)
+
+        return command
+
+    pool = multiprocessing.pool.ThreadPool(max(1, jobs))
+    try:
+        results = pool.imap(execute, commands)
+        for _ in xrange(len(commands)):
+            # A timeout is given so that a KeyboardInterrupt can get through
+            # while we wait.
+            yield results.next(timeout = 60 * 60 * 24 * 365)
+    finally:
+        pool.terminate()
+
+def print_result(item, out = None):
+    """
+    Prints the captured output of a finished command or download under a
+    heading identifying it.
+
+    """
+
+    out = out or ui.output()
+
+    print >> out, "==> %s" % (item, )
+    if item.output:
+        out.write(item.output)
+        if not item.output.endswith("\n"):
+            out.write("\n")
+    out.flush()
+
+def print_summary(commands, finished_downloads = (), out = None,
+        hosts = None):
+    """
+    Prints a summary showing which commands and downloads failed.
+
+    """
+
+    out = out or ui.output()
+
+    failed = [i for i in commands if not i.succeeded]
+
+    print >> out, "%d %s succeeded, %d failed." % (
+        len(commands) - len(failed),
+        pretty.plural_if("command", len(commands) - len(failed)),
+        len(failed)
+    )
+
+    failed_downloads = [i for i in finished_downloads if not i.succeeded]
+    if finished_downloads:
+        print >> out, "%d %s succeeded, %d failed." % (
+            len(finished_downloads) - len(failed_downloads),
+            pretty.plural_if(
+                "download", len(finished_downloads) - len(failed_downloads)
+            ),
+            len(failed_downloads)
+        )
+
+    for i in failed + failed_downloads:
+        print >> out, "    FAILED (exit status %d) %s" % (i.exit_status, i)
+
+    if hosts is not None and len(hosts.hosts) > 1:
+        print >> out, "Servers:"
+        for i in hosts.summary():
+            print >> out, "    " + i
+
+    if retry.stats.retries:
+        print >> out, "Retries: " + retry.stats.summary()
+
+    limiters = [i for i in ratelimit.limiters() if i.enabled]
+    if limiters:
+        print >> out, "Rate limiting:"
+        for i in limiters:
+            print >> out, "    " + i.summary()
+
+def run_batch(session, commands, jobs, download_workers = 1,
+        on_finished = None):
+    """
+    Executes every command, printing each command's output as soon as it and
+    all the commands before it have finished. Any files the server sends are
+    downloaded in the background while the remaining commands execute. A
+    summary is printed at the end.
+
+    ``on_finished`` is passed along to :func:`run_commands`.
+
+    :returns: ``0`` if every command and download succeeded, ``1`` otherwise.
+
+    """
+
+    logger.info(
+        "Executing %d %s with up to %d at a time.",
+        len(commands), pretty.plural_if("command", len(commands)), jobs
+    )
+
+    manager = downloads.DownloadManager(session, download_workers)
+    session.download_manager = manager
+
+    out = ui.output()
+    try:
+        for i in run_commands(session, commands, jobs, on_finished):
+            print_result(i, out)
+
+        finished_downloads = manager.wait()
+    finally:
+        session.download_manager = None
+
+    for i in finished_downloads:
+        print_result(i, out)
+
+    print_summary(
+        commands, finished_downloads, out, session.transport.hosts
+    )
+
+    everything = commands + finished_downloads
+    return 0 if all(i.succeeded for i in everything) else 1
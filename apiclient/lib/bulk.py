@@ -0,0 +1,276 @@
+# Copyright (c) 2013 Galah Group LLC
+# Copyright (c) 2013 Other contributers as noted in the CONTRIBUTERS file
+#
+# This file is part of galah-apiclient.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This module handles executing a command once for every file in a directory
+tree, usually to upload each of them.
+
+The command is given as a template, each word of which is formatted with
+``str.format()`` for every file. The following fields are available:
+
+``path``
+    The absolute path of the file.
+``relpath``
+    The path of the file relative to the directory given.
+``dir``
+    The directory the file is in, relative to the directory given. An empty
+    string for files directly inside of it.
+``name``
+    The name of the file.
+``stem``
+    The name of the file without its extension.
+``parts``
+    A list of the components of ``relpath``.
+
+For example, if every student's submission is in a directory named after
+their email address, they could be uploaded with:
+
+.. code-block:: shell-session
+
+    $ galapi --bulk submissions/ upload_submission {parts[0]} cs100 {path}
+
+Every command that succeeds is recorded in a manifest file, so if the upload
+is interrupted, running the same thing again will skip the files that were
+already uploaded.
+
+"""
+
+import os
+import sys
+import pipes
+import fnmatch
+import threading
+
+import batch
+import utils
+import pretty
+
+import logging
+logger = logging.getLogger("apiclient.bulk")
+
+#: The name of the manifest file that is used if one isn't specified. It is
+#: placed in the directory being uploaded from.
+DEFAULT_MANIFEST_NAME = ".galah-bulk-manifest"
+
+class Manifest:
+    """
+    A record of which commands have been completed successfully.
+
+    The manifest is a file with one JSON object per line, and is only ever
+    appended to, so a crash can at worst lose the line being written.
+
+    An item is identified by the command that was executed along with the
+    size and modification time of its file, so a file that is changed after
+    it was uploaded will be uploaded again.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(command, file_path):
+        stat = os.stat(file_path)
+        return "%s\0%d\0%d" % (command, stat.st_size, int(stat.st_mtime))
+
+    def load(self):
+        """
+        Reads in the items that have already been completed. Lines that can't
+        be parsed (such as one that was only partially written) are ignored.
+
+        """
+
+        if not os.path.isfile(self.path):
+            return
+
+        json = utils.json_module()
+        with open(self.path, "rb") as f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    self.completed.add(json.loads(line)["key"])
+                except (ValueError, KeyError, TypeError):
+                    logger.warning(
+                        "Ignoring unreadable line %d in manifest at %s.",
+                        line_number, self.path
+                    )
+
+        logger.debug(
+            "Loaded %d completed items from manifest at %s.",
+            len(self.completed), self.path
+        )
+
+    def __contains__(self, key):
+        return key in self.completed
+
+    def record(self, key, relpath):
+        """
+        Appends a completed item to the manifest.
+
+        """
+
+        line = utils.to_json({"key": key, "path": relpath}) + "\n"
+        with self.lock:
+            with open(self.path, "ab") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+            self.completed.add(key)
+
+def find_files(directory, pattern = "*", exclude = ()):
+    """
+    Finds every file beneath a directory whose name matches a pattern.
+
+    :param directory: The directory to search.
+    :param pattern: A shell-style wildcard pattern (see ``fnmatch``) that file
+            names must match.
+    :param exclude: A list of absolute paths to leave out.
+    :returns: A sorted list of absolute paths.
+
+    """
+
+    exclude = set(exclude)
+
+    found = []
+    for dir_path, dir_names, file_names in os.walk(directory):
+        # Skip hidden directories, and sort the rest so they are walked in a
+        # consistent order.
+        dir_names[:] = sorted(i for i in dir_names if not i.startswith("."))
+
+        for i in file_names:
+            path = os.path.join(dir_path, i)
+            if fnmatch.fnmatch(i, pattern) and path not in exclude:
+                found.append(path)
+
+    return sorted(found)
+
+def expand_template(template, directory, file_path):
+    """
+    Formats every word of a command template for a particular file.
+
+    :returns: A list of words.
+
+    """
+
+    relpath = os.path.relpath(file_path, directory)
+    name = os.path.basename(file_path)
+    fields = {
+        "path": file_path,
+        "relpath": relpath,
+        "dir": os.path.dirname(relpath),
+        "name": name,
+        "stem": os.path.splitext(name)[0],
+        "parts": relpath.split(os.sep)
+    }
+
+    return [i.format(**fields) for i in template]
+
+def build_commands(directory, template, files, manifest):
+    """
+    Creates a command for every file that hasn't been completed already.
+
+    :returns: A list of ``(command, key)`` tuples, where ``command`` is a
+            :class:`batch.BatchCommand` and ``key`` identifies it in the
+            manifest.
+
+    """
+
+    commands = []
+    for path in files:
+        try:
+            args = expand_template(template, directory, path)
+        except (KeyError, IndexError, ValueError) as e:
+            logger.critical(
+                "Could not fill in command template for %s: %s.", path,
+                str(e)
+            )
+            sys.exit(1)
+
+        raw = " ".join(pipes.quote(i) for i in args)
+
+        key = Manifest.key(raw, path)
+        if key in manifest:
+            logger.debug("Skipping %s which was already completed.", path)
+            continue
+
+        commands.append((
+            batch.BatchCommand(os.path.relpath(path, directory), raw, args),
+            key
+        ))
+
+    return commands
+
+def run_bulk(session, directory, template, pattern = "*",
+        manifest_path = None, jobs = 1, download_workers = 1):
+    """
+    Executes a command for every matching file beneath ``directory``, skipping
+    any that the manifest says have already been done.
+
+    :param session: The :class:`communicate.APIClientSession` to use.
+    :param directory: The directory to search for files.
+    :param template: A list of words making up the command template.
+    :param pattern: A shell-style wildcard pattern file names must match.
+    :param manifest_path: Where to keep the manifest. Defaults to
+            :data:`DEFAULT_MANIFEST_NAME` inside of ``directory``.
+    :param jobs: The maximum number of commands to execute at once.
+    :param download_workers: The number of files to download at once if the
+            server sends any back.
+    :returns: ``0`` if every command succeeded, ``1`` otherwise.
+
+    """
+
+    if not template:
+        logger.critical("No command template given.")
+        sys.exit(1)
+
+    directory = utils.resolve_path(directory)
+    if not os.path.isdir(directory):
+        logger.critical("%s is not a directory.", directory)
+        sys.exit(1)
+
+    if manifest_path is None:
+        manifest_path = os.path.join(directory, DEFAULT_MANIFEST_NAME)
+    manifest_path = utils.resolve_path(manifest_path)
+
+    manifest = Manifest(manifest_path)
+    manifest.load()
+
+    files = find_files(directory, pattern, exclude = [manifest_path])
+    pending = build_commands(directory, template, files, manifest)
+
+    skipped = len(files) - len(pending)
+    if skipped:
+        logger.info(
+            "Skipping %d %s already completed according to %s.", skipped,
+            pretty.plural_if("file", skipped), manifest_path
+        )
+
+    if not pending:
+        logger.info("Nothing to do.")
+        return 0
+
+    keys = dict((id(command), key) for command, key in pending)
+    def record(command):
+        if command.succeeded:
+            manifest.record(keys[id(command)], command.label)
+
+    return batch.run_batch(
+        session, [command for command, _ in pending], jobs, download_workers,
+        on_finished = record
+    )
@@ -21,67 +21,98 @@ This module is responsible for all communications with the Galah server.
 """
 
 import pprint
-import pickle
 import os
 import os.path
 import sys
 import time
+import socket
+import httplib
 import urlparse
 import copy
-import webbrowser
-import shutil
+import threading
+import hashlib
 
-# pkg_resources doesn't like being imported inside of a super zip very much so
-# we want to supress its warnings.
-import warnings
-with warnings.catch_warnings():
-    warnings.simplefilter("ignore")
-    import pkg_resources
+# Modules that are only needed by some commands (such as pkg_resources, pickle,
+# webbrowser and multipart) are imported where they are used, to keep starting
+# up quick.
 
 import function
+import apicache
+import responsecache
+import ratelimit
+import retry
+import hostpool
+import timings
 import config
 import utils
 import ui
+import downloads
 
 import logging
 logger = logging.getLogger("apiclient.communicate")
 
 requests = utils.requests_module()
 
+#: Held while choosing the name of a file to download to.
+_download_path_lock = threading.Lock()
+
+#: The paths of the partial downloads currently being written to by this
+#: process.
+_active_partial_downloads = set()
+
+#: The number of seconds to wait for the server to respond when checking if a
+#: download is ready.
+DOWNLOAD_POLL_TIMEOUT = 5
+
+#: The number of bytes of a text response to read and print at a time. Small
+#: enough that output starts appearing as soon as the server starts sending it.
+RESPONSE_CHUNK_SIZE = 8 * 1024
+
+#: How much of a download may be written before the amount written is saved,
+#: so it can be resumed from there. It is also saved at least once a second.
+DOWNLOAD_CHECKPOINT_SIZE = 4 * 1024 * 1024
+
 def _parse_api_info(api_info):
     """
     Breaks up API info into a more useable form.
 
     :param api_info: A list of dictionaries as returned by Galah.
-    :returns: A dictionary such that each value is a :class:`function.Function`
-            object, and each key is the name of the function.
+    :returns: A :class:`function.FunctionIndex` mapping the name of each
+            function to a :class:`function.Function` object.
 
     """
 
-    result = {}
-    for command in api_info:
-        parameters = []
-        for i in command.get("args", []):
-            if i.get("takes_file", False):
-                parameter_type = file
-            else:
-                parameter_type = str
+    return function.FunctionIndex(function.compile_api_info(api_info))
 
-            parameters.append(
-                function.Function.Parameter(
-                    name = i["name"],
-                    default_value = i.get("default_value"),
-                    param_type = parameter_type
-                )
-            )
+#: Incremented whenever the layout of the session file changes. The first
+#: layout was a ``(user, cookies)`` tuple where ``cookies`` was a dictionary
+#: of cookie names and values.
+SESSION_FORMAT_VERSION = 2
 
-        result[command["name"]] = function.Function(
-            name = command["name"],
-            params = parameters
-        )
+#: The attributes of a cookie that are saved in the session file. These are
+#: the arguments ``requests.cookies.create_cookie()`` accepts.
+_COOKIE_ATTRIBUTES = (
+    "version", "name", "value", "port", "domain", "path", "secure", "expires",
+    "discard", "comment", "comment_url", "rfc2109"
+)
 
+def _cookie_to_dict(cookie):
+    result = dict((i, getattr(cookie, i)) for i in _COOKIE_ATTRIBUTES)
+    result["rest"] = dict(getattr(cookie, "_rest", {}))
     return result
 
+def _cookie_from_dict(cookie):
+    return requests.cookies.create_cookie(**cookie)
+
+def _log_api_info(api_info):
+    # Building every function just to log it is only worth it if the message
+    # will actually go somewhere.
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Loaded API info...\n%s",
+            "\n".join(str(i) for i in api_info.values())
+        )
+
 def _get_authorities_file():
     """
     Returns the path to the file containing the certificate authorities'
@@ -100,6 +131,15 @@ def _get_authorities_file():
             config.CONFIG["ca-certs-path"]
         )
 
+        import shutil
+
+        # pkg_resources doesn't like being imported inside of a super zip very
+        # much so we want to supress its warnings.
+        import warnings
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            import pkg_resources
+
         source = pkg_resources.resource_stream("requests.utils", "cacert.pem")
         dest = utils.open_secure_file(config.CONFIG["ca-certs-path"])
 
@@ -121,6 +161,361 @@ def _get_verify():
     else:
         return _get_authorities_file()
 
+def _make_ssl_context(verify):
+    """
+    Creates an SSL context with the certificate authorities in ``verify``
+    already loaded.
+
+    :returns: An ``ssl.SSLContext`` or ``None`` if certificates are not being
+            verified or this version of Python does not support SSL contexts.
+
+    """
+
+    if not verify:
+        return None
+
+    import ssl
+    if not hasattr(ssl, "create_default_context"):
+        return None
+
+    # Older versions of requests (such as the one rauth depends on) come with
+    # a version of urllib3 that can't be given an SSL context.
+    try:
+        from requests.packages.urllib3.util.ssl_ import create_urllib3_context
+    except ImportError:
+        return None
+
+    try:
+        return ssl.create_default_context(cafile = verify)
+    except (ssl.SSLError, IOError):
+        logger.warning(
+            "Could not load certificate authorities from '%s'.", verify,
+            exc_info = sys.exc_info()
+        )
+
+        return None
+
+def _preallocate(f, size):
+    """
+    Reserves ``size`` bytes on disk for the file object ``f`` so the file
+    system doesn't have to keep growing it while it is written to. The file
+    position is not changed.
+
+    """
+
+    try:
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(f.fileno(), 0, size)
+        else:
+            f.truncate(size)
+    except (IOError, OSError):
+        logger.debug(
+            "Could not preallocate %d bytes for %s.", size, f.name,
+            exc_info = True
+        )
+
+def _claim_partial_download(file_path, url):
+    """
+    Finds a partial download to write to for a file that will end up at
+    ``file_path``. If a previous attempt at downloading the file was
+    interrupted, its partial download is returned so it can be resumed.
+
+    :returns: A :class:`downloads.PartialDownload`. It must be removed from
+            :data:`_active_partial_downloads` once it is finished with.
+
+    """
+
+    directory, file_name = os.path.split(file_path)
+
+    with _download_path_lock:
+        count = 0
+        while True:
+            suffix = " (%d)" % (count, ) if count else ""
+            part = downloads.PartialDownload(
+                os.path.join(
+                    directory, utils.postfix_file_name(file_name, suffix)
+                ),
+                url
+            )
+
+            if part.path not in _active_partial_downloads:
+                _active_partial_downloads.add(part.path)
+                break
+
+            count += 1
+
+    part.load()
+
+    return part
+
+def _plan_segments(response):
+    """
+    Decides whether a file should be downloaded in several pieces at once
+    (see ``download-segments``), and if so, how to split it up.
+
+    :param response: The server's 200 response to a request for the whole file.
+    :returns: A list of ``(start, end)`` tuples giving the inclusive byte
+            range of each piece, or ``None`` if the file should be downloaded
+            in one go.
+
+    """
+
+    max_segments = config.CONFIG["download-segments"]
+    min_segment_size = max(1, config.CONFIG["download-min-segment-size"])
+
+    if max_segments <= 1 or response.status_code != requests.codes.ok:
+        return None
+
+    # We can only split up the file if we know how big it is and the server
+    # will send us parts of it.
+    if response.headers.get("Accept-Ranges", "").lower() != "bytes" or \
+            "content-encoding" in response.headers:
+        return None
+
+    try:
+        size = int(response.headers["content-length"])
+    except (KeyError, ValueError):
+        return None
+
+    count = min(max_segments, size // min_segment_size)
+    if count <= 1:
+        return None
+
+    segment_size = size // count
+    starts = [i * segment_size for i in xrange(count)]
+    ends = [i - 1 for i in starts[1:]] + [size - 1]
+
+    return zip(starts, ends)
+
+def _print_text(chunks, encoding, on_broken_pipe = None):
+    """
+    Writes a body to the output as it arrives, followed by a newline.
+
+    The body is decoded with ``encoding``, or UTF-8 if it is ``None``, and
+    re-encoded for the output.
+
+    If the output is a pipe that gets closed early (for example, when our
+    output is piped into ``head``) we stop quietly and exit with the same
+    status as if we had been killed by ``SIGPIPE``.
+
+    :param chunks: An iterable of strings making up the body.
+    :param on_broken_pipe: A function to call before exiting if the output
+            is closed early.
+
+    """
+
+    import codecs
+    import errno
+
+    out = ui.output()
+    out_encoding = getattr(out, "encoding", None) or "utf-8"
+
+    decoder = codecs.getincrementaldecoder(encoding or "utf-8")(
+        errors = "replace"
+    )
+
+    try:
+        for chunk in chunks:
+            text = decoder.decode(chunk)
+            if text:
+                out.write(text.encode(out_encoding, "replace"))
+                out.flush()
+
+        text = decoder.decode("", final = True) + u"\n"
+        out.write(text.encode(out_encoding, "replace"))
+        out.flush()
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+
+        if on_broken_pipe is not None:
+            on_broken_pipe()
+
+        # Point standard out somewhere harmless so Python doesn't complain
+        # about being unable to flush it when it exits.
+        if out is sys.stdout:
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+
+        sys.exit(128 + 13) # 13 is SIGPIPE
+
+def _print_response(response, record = None):
+    """
+    Writes the body of a streamed response to the output as it arrives (see
+    :func:`_print_text`).
+
+    :param record: If given, a list every chunk of the body is appended to.
+
+    """
+
+    def chunks():
+        for chunk in response.iter_content(RESPONSE_CHUNK_SIZE):
+            if record is not None:
+                record.append(chunk)
+
+            yield chunk
+
+    _print_text(chunks(), response.encoding, on_broken_pipe = response.close)
+
+def _content_range_start(response):
+    """
+    Returns the offset of the first byte in a 206 response, or ``None`` if it
+    has no valid ``Content-Range`` header.
+
+    """
+
+    content_range = response.headers.get("Content-Range", "")
+    try:
+        unit, byte_range = content_range.split(" ", 1)
+        if unit != "bytes":
+            return None
+
+        return int(byte_range.split("-", 1)[0])
+    except ValueError:
+        return None
+
+class DownloadInterrupted(requests.exceptions.ConnectionError):
+    """
+    Raised when receiving a file fails part of the way through, because the
+    connection failed or the server sent a different amount of the file than
+    its ``Content-Length`` said it would.
+
+    It is a ``ConnectionError`` so that :class:`retry.RetryPolicy` retries
+    it.
+
+    :ivar received: The number of bytes of the file received.
+    :ivar expected: The size of the file, or ``0`` if it isn't known.
+
+    """
+
+    def __init__(self, received, expected, reason = None):
+        if expected:
+            message = "The download was interrupted after %d of %d bytes" % (
+                received, expected
+            )
+        else:
+            message = "The download was interrupted after %d bytes" % (
+                received,
+            )
+        if reason is not None:
+            message += " (%s)" % (reason, )
+
+        requests.exceptions.ConnectionError.__init__(self, message + ".")
+        self.received = received
+        self.expected = expected
+
+class TransportContext:
+    """
+    Holds everything needed to send a request to Galah that does not change
+    from request to request, so it is only worked out once per session.
+
+    :ivar hosts: A :class:`hostpool.HostPool` of the servers Galah is running
+            on.
+    :ivar verify: The value to provide as the verify parameter for calls to
+            requests (see :func:`_get_verify`).
+    :ivar ssl_context: An ``ssl.SSLContext`` with the certificate authorities
+            in ``verify`` preloaded, or ``None``.
+    :ivar json_headers: The headers to send along with a JSON request.
+
+    """
+
+    def __init__(self, hosts, verify):
+        self.hosts = hostpool.HostPool(hosts)
+        self.verify = verify
+        self.ssl_context = _make_ssl_context(verify)
+        self.json_headers = {"Content-Type": "application/json"}
+
+    @classmethod
+    def from_config(cls):
+        return cls(hostpool.parse_hosts(config.CONFIG["host"]), _get_verify())
+
+class _Flight(object):
+    """
+    A call that other threads may be waiting on the response to.
+
+    :ivar done: Set once the call has finished.
+    :ivar result: ``(encoding, body)`` if the call succeeded with a text
+            response, otherwise ``None``.
+
+    """
+
+    __slots__ = ("done", "result")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+class _PooledAdapter(requests.adapters.HTTPAdapter):
+    """
+    A transport adapter that wraps every connection using a preloaded SSL
+    context rather than reloading the certificate authorities file for each
+    new connection.
+
+    """
+
+    def __init__(self, ssl_context = None, *args, **kwargs):
+        # Must be set before the base constructor creates the pool manager.
+        self.ssl_context = ssl_context
+
+        requests.adapters.HTTPAdapter.__init__(self, *args, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.ssl_context is not None:
+            kwargs["ssl_context"] = self.ssl_context
+
+        return requests.adapters.HTTPAdapter.init_poolmanager(
+            self, *args, **kwargs
+        )
+
+    def cert_verify(self, conn, url, verify, cert):
+        requests.adapters.HTTPAdapter.cert_verify(
+            self, conn, url, verify, cert
+        )
+
+        # The certificate authorities are already loaded into the context, so
+        # don't have them loaded again.
+        if self.ssl_context is not None and verify and \
+                url.lower().startswith("https"):
+            conn.ca_certs = None
+            conn.ca_cert_dir = None
+
+def _new_requests_session(transport):
+    """
+    Creates a requests session with a connection pool configured according to
+    the ``pool-connections``, ``pool-maxsize``, ``max-retries`` and
+    ``no-keep-alive`` configuration values.
+
+    Every request we make should go through a single one of these so that
+    connections (and their TLS handshakes) are reused.
+
+    :param transport: The session's :class:`TransportContext`.
+
+    """
+
+    session = requests.session()
+
+    # Concurrent commands each need a connection of their own, so make sure
+    # the pool is at least large enough for the number of jobs.
+    adapter = _PooledAdapter(
+        ssl_context = transport.ssl_context,
+        pool_connections = config.CONFIG["pool-connections"],
+        pool_maxsize =
+            max(config.CONFIG["pool-maxsize"], config.CONFIG["jobs"])
+    )
+
+    # Older versions of requests (such as the one rauth depends on) don't
+    # accept max_retries in the constructor, but every version reads it from
+    # here when sending a request.
+    adapter.max_retries = config.CONFIG["max-retries"]
+
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    if config.CONFIG.get("no-keep-alive"):
+        session.headers["Connection"] = "close"
+
+    return session
+
 class APIClientSession:
     """
     Represents an authenticated API client session.
@@ -134,10 +529,66 @@ class APIClientSession:
     def __init__(self, requests_session = None, user = None,
             api_info_raw = None, api_info = None):
         self.user = user
-        self.requests_session = requests_session
+        self.transport = TransportContext.from_config()
+        self.requests_session = \
+            requests_session or _new_requests_session(self.transport)
         self.api_info_raw = api_info_raw
         self.api_info = api_info
 
+        #: The ETag the server sent along with the API info, if any.
+        self.api_info_etag = None
+
+        #: The SHA-1 hash of the API info as the server sent it.
+        self.api_info_digest = None
+
+        #: When the API info was last checked against the server, as a Unix
+        #: timestamp.
+        self.api_info_checked = None
+
+        # Used to make sure the API info is only refreshed once when an
+        # unknown command is seen, even if many threads see it at once.
+        self._api_info_lock = threading.Lock()
+        self._api_info_refreshed = False
+
+        # Incremented every time we log in again after the server rejected
+        # our session, so threads that were turned away at the same time only
+        # log in once between them.
+        self._login_lock = threading.Lock()
+        self._login_generation = 0
+
+        # The generation in which logging in again didn't help, meaning the
+        # server is refusing us for some other reason.
+        self._relogin_failed_generation = None
+
+        #: If set to a :class:`downloads.DownloadManager`, files the server
+        #: sends us will be downloaded in the background by it.
+        self.download_manager = None
+
+        #: A :class:`responsecache.ResponseCache`, or ``None`` if responses
+        #: aren't cached.
+        self.response_cache = responsecache.from_config()
+
+        #: The commands that identical, concurrent calls to may share a
+        #: single request.
+        self.coalesce_commands = config.command_set("coalesce-commands")
+
+        #: Decides when failed requests are sent again.
+        self.retry_policy = retry.RetryPolicy.from_config()
+
+        #: The commands that may safely be sent to the server more than once.
+        #: Commands that may be cached or coalesced are read-only, so they
+        #: are too.
+        self.idempotent_commands = (
+            config.command_set("idempotent-commands") |
+            config.command_set("cache-commands") |
+            config.command_set("coalesce-commands")
+        )
+
+        # The coalescable calls currently in progress, see
+        # _execute_coalesced().
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+
     def save(self):
         """
         Saves the session.
@@ -159,15 +610,18 @@ class APIClientSession:
                         os.path.dirname(session_file_path)
                     )
 
+                import pickle
                 with open(session_file_path, "w") as f:
                     os.chmod(session_file_path, 0o600)
                     pickle.dump(
-                        (
-                            self.user,
-                            requests.utils.dict_from_cookiejar(
-                                self.requests_session.cookies
-                            )
-                        ),
+                        {
+                            "version": SESSION_FORMAT_VERSION,
+                            "user": self.user,
+                            "cookies": [
+                                _cookie_to_dict(i)
+                                    for i in self.requests_session.cookies
+                            ]
+                        },
                         f
                     )
             except IOError:
@@ -191,6 +645,12 @@ class APIClientSession:
 
                 with open(api_info_file_path, "wb") as f:
                     f.write(self.api_info_raw)
+
+                if isinstance(self.api_info, function.FunctionIndex):
+                    apicache.save(
+                        api_info_file_path, self.api_info_raw,
+                        self.api_info.compiled
+                    )
             except IOError:
                 logger.warn(
                     "Could not save API Info to %s.",
@@ -198,6 +658,15 @@ class APIClientSession:
                     exc_info = sys.exc_info()
                 )
 
+        if self.api_info_checked is not None and \
+                os.path.isfile(api_info_file_path):
+            apicache.save_meta(api_info_file_path, {
+                "etag": self.api_info_etag,
+                "sha1": self.api_info_digest,
+                "checked": self.api_info_checked
+            })
+
+    @timings.timed("load")
     def load(self):
         """
         Loads any data saved by a previous call to :meth:`save`.
@@ -209,13 +678,27 @@ class APIClientSession:
         if os.path.isfile(session_file_path):
             logger.info("Loading session file from %s.", session_file_path)
 
+            import pickle
             try:
                 with open(session_file_path, "r") as f:
                     try:
-                        self.user, raw_cookie_jar = pickle.load(f)
-                        self.requests_session = requests.session()
-                        self.requests_session.cookies = \
-                            requests.utils.cookiejar_from_dict(raw_cookie_jar)
+                        saved = pickle.load(f)
+                        if isinstance(saved, tuple):
+                            # Session files from older versions only have the
+                            # names and values of the cookies.
+                            self.user, raw_cookie_jar = saved
+                            requests.utils.add_dict_to_cookiejar(
+                                self.requests_session.cookies, raw_cookie_jar
+                            )
+                        else:
+                            self.user = saved["user"]
+                            for i in saved["cookies"]:
+                                self.requests_session.cookies.set_cookie(
+                                    _cookie_from_dict(i)
+                                )
+
+                            # In case servers were added since we logged in.
+                            self._replicate_cookies()
                     except:
                         logger.critical(
                             "Could not load cached request object. Try "
@@ -237,6 +720,19 @@ class APIClientSession:
         if os.path.isfile(api_info_file_path):
             logger.info("Loading API Info from %s.", api_info_file_path)
 
+            meta = apicache.load_meta(api_info_file_path)
+            self.api_info_etag = meta.get("etag")
+            self.api_info_digest = meta.get("sha1")
+            self.api_info_checked = meta.get("checked")
+
+            # The snapshot is used as-is, so api_info_raw is left unset and
+            # save() won't rewrite a file that hasn't changed.
+            self.api_info = apicache.load(api_info_file_path)
+            if self.api_info is not None:
+                logger.debug("Using compiled snapshot of API info.")
+                _log_api_info(self.api_info)
+                return
+
             try:
                 with open(api_info_file_path, "rb") as f:
                     self.api_info_raw = f.read().encode("ascii")
@@ -244,10 +740,12 @@ class APIClientSession:
                         utils.json_module().loads(self.api_info_raw)
                     )
 
-                    logger.debug(
-                        "Loaded API info...\n%s",
-                        "\n".join(str(i) for i in self.api_info.values())
-                    )
+                _log_api_info(self.api_info)
+
+                apicache.save(
+                    api_info_file_path, self.api_info_raw,
+                    self.api_info.compiled
+                )
             except IOError:
                 logger.warn(
                     "Could not load API Info from %s.",
@@ -255,6 +753,7 @@ class APIClientSession:
                     exc_info = sys.exc_info()
                 )
 
+    @timings.timed("login")
     def login(self, email, password):
         """
         Attempts to authenticate with Galah using the given email and password.
@@ -266,14 +765,23 @@ class APIClientSession:
 
         """
 
-        session = requests.session()
+        # Throw away any cookies from a previous session but keep the
+        # connections.
+        self.requests_session.cookies.clear()
+
+        def send():
+            return self._send_to_hosts(
+                lambda host: self.requests_session.post(
+                    host.login_url,
+                    data = {"email": email, "password": password},
+                    verify = self.transport.verify
+                ),
+                idempotent = True
+            )
 
         try:
-            request = session.post(
-                urlparse.urljoin(config.CONFIG["host"], "/api/login"),
-                data = {"email": email, "password": password},
-                verify = _get_verify()
-            )
+            # Logging in twice does no harm.
+            request = self.retry_policy.call(send, True, "logging in")
         except requests.exceptions.SSLError as e:
             logger.critical(
                 "There was a problem with communicating via SSL: %s.",
@@ -285,7 +793,7 @@ class APIClientSession:
         except requests.exceptions.ConnectionError:
             logger.critical(
                 "Galah did not respond at %s.",
-                urlparse.urljoin(config.CONFIG["host"], "/api/call"),
+                ", ".join(self.transport.hosts.urls),
                 exc_info = True
             )
 
@@ -297,11 +805,12 @@ class APIClientSession:
             logger.critical("Could not log in with given credientials.")
             sys.exit(1)
 
+        self._replicate_cookies()
         self.user = email
-        self.requests_session = session
 
         logger.info("Logged in as %s.", self.user)
 
+    @timings.timed("login")
     def login_oauth2(self):
         """
         Attempts to authenticate user for Galah using Google OAuth2.
@@ -339,6 +848,7 @@ class APIClientSession:
         if "user" in config.CONFIG:
             params["login_hint"] = config.CONFIG["user"]
 
+        import webbrowser
         webbrowser.open(urlparse.urljoin(
             google.base_url,
             google.get_authorize_url(**params)
@@ -357,15 +867,15 @@ class APIClientSession:
                 "redirect_uri": "urn:ietf:wg:oauth:2.0:oob",
                 "grant_type": "authorization_code"
             },
-            verify = _get_verify()
+            verify = self.transport.verify
         )
 
         # Verify that the user succesfully logged in and figure out what email
         # they used to do it.
-        token_info_request = requests.post(
+        token_info_request = self.requests_session.post(
             "https://www.googleapis.com/oauth2/v1/tokeninfo",
             data = {"access_token": access_token},
-            verify = _get_verify()
+            verify = self.transport.verify
         )
         if token_info_request.status_code != requests.codes.ok:
             logger.critical("Invalid OAuth2 login.")
@@ -377,11 +887,14 @@ class APIClientSession:
 
         # Use the token we got from google to initialize an authenticated
         # session on the Galah server.
-        self.requests_session = requests.session()
-        request = self.requests_session.post(
-            urlparse.urljoin(config.CONFIG["host"], "/api/login"),
-            data = {"access_token": access_token},
-            verify = _get_verify()
+        self.requests_session.cookies.clear()
+        request = self._send_to_hosts(
+            lambda host: self.requests_session.post(
+                host.login_url,
+                data = {"access_token": access_token},
+                verify = self.transport.verify
+            ),
+            idempotent = True
         )
         logger.debug("Galah responded with...\n%s", request.text)
         if request.status_code != requests.codes.ok or \
@@ -389,9 +902,92 @@ class APIClientSession:
             logger.critical("Could not authenticate with Galah.")
             sys.exit(1)
 
+        self._replicate_cookies()
+
         logger.info("Logged in as %s.", self.user)
 
-    def fetch_api_info(self):
+    def session_expired(self):
+        """
+        Returns ``True`` iff every cookie the server gave us has expired,
+        meaning the server will no longer recognize us.
+
+        Cookies that don't have an expiry date (or that came from a session
+        file saved by an older version) are assumed to still be good.
+
+        """
+
+        now = time.time()
+        cookies = list(self.requests_session.cookies)
+        return bool(cookies) and all(
+            i.expires is not None and i.expires <= now for i in cookies
+        )
+
+    def relogin(self):
+        """
+        Logs in again as the current user, in whatever way the user logged in
+        originally, and saves the new session.
+
+        If logging in would require asking the user for something and there
+        is nobody to ask (standard in isn't a terminal), nothing is done.
+
+        :returns: ``True`` if we logged in again, ``False`` otherwise.
+
+        """
+
+        interactive = sys.stdin.isatty()
+
+        if config.CONFIG.get("use-oauth"):
+            if not interactive:
+                logger.warning(
+                    "Cannot log in again with OAuth without a terminal."
+                )
+                return False
+
+            # Not self.login_oauth2 or self.login, which
+            # AsyncAPIClientSession makes return before we're logged in.
+            APIClientSession.login_oauth2(self)
+        else:
+            user = self.user or config.CONFIG.get("user")
+            if not interactive and \
+                    (user is None or "GALAH_PASSWORD" not in os.environ):
+                logger.warning(
+                    "Cannot log in again without a terminal unless the user "
+                    "is known and GALAH_PASSWORD is set."
+                )
+                return False
+
+            APIClientSession.login(self, *ui.determine_credentials(user))
+
+        self.save()
+
+        return True
+
+    def _relogin_after_rejection(self, generation):
+        """
+        Called when the server rejected a request that was sent while
+        ``self._login_generation`` was ``generation``.
+
+        :returns: ``True`` if the request should be sent again.
+
+        """
+
+        with self._login_lock:
+            if self._login_generation != generation:
+                # Another thread already logged in again after we sent ours.
+                return True
+            elif self._relogin_failed_generation == generation:
+                return False
+
+            logger.info("Our session is no longer valid. Logging in again.")
+            if not self.relogin():
+                self._relogin_failed_generation = generation
+                return False
+
+            self._login_generation += 1
+
+            return True
+
+    def fetch_api_info(self, revalidate = False):
         """
         Queries the server for the known API commands.
 
@@ -400,17 +996,46 @@ class APIClientSession:
 
         ``api_info`` will be set appropriately.
 
+        :param revalidate: If ``True``, the API info we already have is only
+                replaced if the server's differs from it. If the server gave
+                us an ETag last time, it is sent along so the server can
+                reply with ``304 Not Modified`` rather than sending everything
+                again.
+        :returns: ``True`` if the API info changed, ``False`` otherwise.
+
         """
 
-        logger.info("Fetching API Info...")
+        headers = None
+        if revalidate and self.api_info is not None:
+            logger.info("Checking for changes to API Info...")
+            if self.api_info_etag:
+                headers = {"If-None-Match": self.api_info_etag}
+        else:
+            logger.info("Fetching API Info...")
+            revalidate = False
 
-        r = self._send_api_command({"api_name": "get_api_info"})
+        r = self._send_api_command(
+            {"api_name": "get_api_info"}, headers = headers
+        )
+        self.api_info_checked = time.time()
 
-        if r.status_code != requests.codes.ok:
+        if r.status_code == requests.codes.not_modified and revalidate:
+            logger.info("API Info is up to date.")
+            return False
+        elif r.status_code != requests.codes.ok:
             logger.critical("Could not get API info from Galah.")
             sys.exit(1)
 
-        self.api_info_raw = r.text.encode("ascii")
+        raw = r.text.encode("ascii")
+        digest = hashlib.sha1(raw).hexdigest()
+        self.api_info_etag = r.headers.get("ETag")
+
+        if revalidate and digest == self.api_info_digest:
+            logger.info("API Info is up to date.")
+            return False
+
+        self.api_info_raw = raw
+        self.api_info_digest = digest
 
         try:
             self.api_info = _parse_api_info(r.json())
@@ -422,9 +1047,77 @@ class APIClientSession:
             )
             sys.exit(1)
 
-        logger.debug(
-            "Loaded API info...\n%s",
-            "\n".join(str(i) for i in self.api_info.values())
+        _log_api_info(self.api_info)
+
+        return True
+
+    def api_info_is_stale(self):
+        """
+        Returns ``True`` iff the API info is old enough that it should be
+        checked against the server again (see the ``api-info-ttl`` option).
+
+        """
+
+        ttl = config.CONFIG["api-info-ttl"]
+        if not ttl:
+            return False
+
+        return self.api_info_checked is None or \
+            time.time() - self.api_info_checked > ttl
+
+    def _refresh_api_info(self):
+        """
+        Checks the server for new commands, unless that has already been done
+        by this session. Any changes are saved.
+
+        """
+
+        with self._api_info_lock:
+            if self._api_info_refreshed:
+                return
+
+            self._api_info_refreshed = True
+
+            # Not self.fetch_api_info, which AsyncAPIClientSession makes
+            # return before the API info has been fetched.
+            APIClientSession.fetch_api_info(self, revalidate = True)
+            self.save()
+
+    def revalidate_api_info(self):
+        """
+        Checks the API info against the server if it is stale, saving any
+        changes. Meant for sessions that live much longer than a single
+        command, which would otherwise only ever check once.
+
+        """
+
+        with self._api_info_lock:
+            if not self.api_info_is_stale():
+                return
+
+            APIClientSession.fetch_api_info(self, revalidate = True)
+            self.save()
+
+            # Let the next unknown command check again too.
+            self._api_info_refreshed = False
+
+    def _response_cache_key(self, command, request):
+        """
+        Returns the key the response to a command is cached under, or
+        ``None`` if it can't be cached.
+
+        """
+
+        if self.response_cache is None or \
+                command not in self.response_cache.commands:
+            return None
+
+        # Uploads are never cached.
+        if any(i.param_type is file for i in self.api_info[command].params):
+            return None
+
+        return self.response_cache.key(
+            self.transport.hosts.urls, self.user, command, request
         )
 
     def call(self, command, *args, **kwargs):
@@ -439,12 +1132,23 @@ class APIClientSession:
 
         """
 
+        with timings.record(command):
+            self._call(command, *args, **kwargs)
+
+    def _call(self, command, *args, **kwargs):
+        """
+        See :meth:`call`.
+
+        """
+
         if command not in self.api_info:
-            logger.critical(
-                "%s is not a known command. You can try using "
-                " --clear-api-info to reload the list of available commands.",
-                command
-            )
+            # The server may have gained the command since we last asked it
+            # what commands it has.
+            logger.info("%s is not a known command yet.", command)
+            self._refresh_api_info()
+
+        if command not in self.api_info:
+            logger.critical("%s is not a known command.", command)
             sys.exit(1)
 
         try:
@@ -467,6 +1171,99 @@ class APIClientSession:
             pprint.pformat(request, width = 72)
         )
 
+        cache_key = self._response_cache_key(command, request)
+        if cache_key is not None:
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                logger.info("Using cached response to %s command.", command)
+                _print_text([cached[1]], cached[0])
+                return
+
+        if self._coalescable(command):
+            result = self._execute_coalesced(command, request)
+        else:
+            result = self._execute(
+                command, request, record = cache_key is not None
+            )
+
+        if cache_key is not None and result is not None:
+            self.response_cache.put(cache_key, *result)
+
+    def _coalescable(self, command):
+        """
+        Returns ``True`` iff identical, concurrent calls to ``command`` may
+        share one request to the server (see the ``coalesce-commands``
+        option).
+
+        """
+
+        if command not in self.coalesce_commands:
+            return False
+
+        return not any(
+            i.param_type is file for i in self.api_info[command].params
+        )
+
+    def _execute_coalesced(self, command, request):
+        """
+        Like :meth:`_execute`, except that if an identical call is already in
+        progress in another thread, we wait for it and print its response
+        rather than sending the same request again.
+
+        Only successful text responses are shared. If the call we waited on
+        failed or the server sent a file, we send our own request.
+
+        :returns: What :meth:`_execute` returned if we sent the request,
+                otherwise ``None``.
+
+        """
+
+        key = utils.to_json([command, sorted(request.items())])
+
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if leader:
+            try:
+                flight.result = self._execute(command, request, record = True)
+                return flight.result
+            finally:
+                with self._flights_lock:
+                    del self._flights[key]
+                flight.done.set()
+
+        logger.info(
+            "An identical %s command is already in progress. Waiting for "
+            "it to finish.", command
+        )
+
+        # Wait with a timeout so a KeyboardInterrupt can get through.
+        while not flight.done.is_set():
+            flight.done.wait(0.1)
+
+        if flight.result is None:
+            logger.debug("Could not share the response, sending our own.")
+            return self._execute(command, request, record = True)
+
+        _print_text([flight.result[1]], flight.result[0])
+        return None
+
+    def _execute(self, command, request, record = False):
+        """
+        Sends a command to the server and handles the response.
+
+        :param request: The command's resolved arguments, including
+                ``api_name``.
+        :param record: If ``True``, a text response is kept and returned as
+                well as printed.
+        :returns: ``(encoding, body)`` if ``record`` is ``True`` and the
+                server sent back text, otherwise ``None``.
+
+        """
+
         for i in self.api_info[command].params:
             if i.param_type is file:
                 logger.debug("Loading file for parameter %s.", i.name)
@@ -484,7 +1281,34 @@ class APIClientSession:
             "Executing %s command on Galah as user %s.", command, self.user
         )
 
-        r = self._send_api_command(request)
+        generation = self._login_generation
+        if self.session_expired() and \
+                self._relogin_after_rejection(generation):
+            generation = self._login_generation
+
+        # The body isn't read until we know what to do with it, so large
+        # responses can be streamed to the user.
+        r = self._send_api_command(request, stream = True)
+
+        # If our session was rejected, log in again and replay the request
+        # once.
+        if r.headers.get("X-CallSuccess") != "True" and \
+                r.headers.get("X-ErrorType") == "PermissionError":
+            r.content
+            if self._relogin_after_rejection(generation):
+                for i in request.values():
+                    if isinstance(i, file):
+                        i.seek(0)
+
+                retry_generation = self._login_generation
+                r = self._send_api_command(request, stream = True)
+
+                # Logging in again didn't help, so don't bother next time.
+                if r.headers.get("X-ErrorType") == "PermissionError":
+                    with self._login_lock:
+                        if self._login_generation == retry_generation:
+                            self._relogin_failed_generation = \
+                                retry_generation
 
         if r.headers.get("X-CallSuccess") != "True":
             if "X-ErrorType" not in r.headers:
@@ -506,77 +1330,73 @@ class APIClientSession:
 
             sys.exit(1)
         elif r.status_code != requests.codes.ok:
+            r.close()
             logger.critical("An unknown server error occurred.")
             sys.exit(1)
 
         # If the response is a file...
         if "X-Download" in r.headers:
+            # Read the (small) body so the connection goes back to the pool.
+            r.content
+
             default_name = r.headers.get(
                 "X-Download-DefaultName", "downloaded_file"
             )
 
-            url = urlparse.urljoin(
-                config.CONFIG["host"], r.headers["X-Download"]
-            )
-
-            self.download(url, default_name)
-        else:
-            print r.text
-
-    def _requester(self):
-        """
-        Determines the most appropriate object to send an HTTP request through.
-
-        :returns: Either the ``requests`` module itself, or a
-                ``requests.Session`` object.
-
-        Use this function whenever your about to send a get or post request to
-        the server.
-
-        .. code-block::
+            # The file is fetched from whichever server prepared it.
+            url = urlparse.urljoin(r.url, r.headers["X-Download"])
 
-            self._requester().get("https://galah.galah.com/do/things")
-
-        """
-
-        if self.requests_session:
-            return self.requests_session
+            if self.download_manager is not None:
+                self.download_manager.submit(url, default_name)
+                print >> ui.output(), \
+                    "Downloading %s in the background." % (default_name, )
+            else:
+                # Named explicitly so AsyncAPIClientSession doesn't hand the
+                # download off to another thread and return before it's done.
+                APIClientSession.download(self, url, default_name)
+        elif record:
+            body = []
+            with timings.phase("response"):
+                _print_response(r, body)
+            return (r.encoding, "".join(body))
         else:
-            return requests
+            with timings.phase("response"):
+                _print_response(r)
 
-    def _send_api_command(self, request):
+    def _send_api_command(self, request, stream = False, headers = None):
         """
         Send an API command to Galah.
 
         :param request: A properly formed JSON object to send Galah.
+        :param stream: If ``True``, the body of the response won't be read
+                until it is accessed, as with the ``stream`` parameter to
+                ``requests.post``.
+        :param headers: A dictionary of any extra headers to send.
         :returns: A ``requests.Response`` object.
 
         """
 
-        request = copy.copy(request)
+        api_name = request.get("api_name")
+        idempotent = api_name == "get_api_info" or \
+            api_name in self.idempotent_commands
 
-         # Extract any files
-        file_args = {}
-        for i in (k for k, v in request.items() if isinstance(v, file)):
-            file_args[str(i)] = request.pop(i)
+        def post(host):
+            for i in request.values():
+                if isinstance(i, file):
+                    i.seek(0)
 
-        try:
-            requester = self._requester()
-
-            if not file_args:
-                return requester.post(
-                    urlparse.urljoin(config.CONFIG["host"], "/api/call"),
-                    data = utils.to_json(request),
-                    headers = {"Content-Type": "application/json"},
-                    verify = _get_verify()
-                )
-            else:
-                return requester.post(
-                    urlparse.urljoin(config.CONFIG["host"], "/api/call"),
-                    data = {"request": utils.to_json(request)},
-                    files = file_args,
-                    verify = _get_verify()
+            with timings.phase("server"):
+                return self._post_api_command(
+                    host, request, stream, headers
                 )
+
+        def send():
+            return self._send_to_hosts(post, idempotent)
+
+        try:
+            return self.retry_policy.call(
+                send, idempotent, "the %s command" % (api_name, )
+            )
         except requests.exceptions.SSLError as e:
             logger.critical(
                 "There was a problem with communicating via SSL: %s.",
@@ -588,29 +1408,158 @@ class APIClientSession:
         except requests.exceptions.ConnectionError:
             logger.critical(
                 "Galah did not respond at %s.",
-                urlparse.urljoin(config.CONFIG["host"], "/api/call"),
+                ", ".join(self.transport.hosts.urls),
                 exc_info = True
             )
 
             sys.exit(1)
 
-    def download(self, url, file_name):
+    def _send_to_hosts(self, send, idempotent):
+        """
+        Sends a request to the healthiest server, or to the next healthiest
+        if that one can't be reached, and so on.
+
+        Each server's rate limits (see :mod:`ratelimit`) are applied.
+
+        :param send: A function that sends the request to the given
+                :class:`hostpool.Host` and returns a ``requests.Response``.
+        :param idempotent: If ``False``, the request is only sent to another
+                server if it can't have reached the first one.
+        :returns: The response.
+        :raises: Whatever ``send`` raised for the last server tried.
+
+        """
+
+        pool = self.transport.hosts
+        candidates = pool.candidates()
+        for index, host in enumerate(candidates):
+            limiter = ratelimit.for_host(host.url)
+            token = None
+            if limiter.enabled:
+                with timings.phase("rate-limit"):
+                    token = limiter.acquire()
+            pool.started(host)
+            started = time.time()
+
+            r = None
+            try:
+                r = send(host)
+            except requests.exceptions.ConnectionError as e:
+                pool.finished(host, time.time() - started, False, False)
+
+                is_last = index == len(candidates) - 1
+                if is_last or \
+                        isinstance(e, requests.exceptions.SSLError) or \
+                        not (idempotent or retry.never_sent(e)):
+                    raise
+
+                logger.warn(
+                    "Could not reach %s, trying %s instead.", host,
+                    candidates[index + 1]
+                )
+            else:
+                pool.finished(
+                    host, time.time() - started, r.status_code < 500
+                )
+                return r
+            finally:
+                limiter.release(token, r)
+
+    def _replicate_cookies(self):
+        """
+        Copies the cookies the server we logged in through gave us to every
+        other server, as they all share the same sessions.
+
+        """
+
+        domains = set(
+            hostpool.effective_domain(i) for i in self.transport.hosts.urls
+        )
+        if len(domains) < 2:
+            return
+
+        jar = self.requests_session.cookies
+        for cookie in list(jar):
+            if cookie.domain not in domains:
+                continue
+
+            for domain in domains - set([cookie.domain]):
+                copy = _cookie_to_dict(cookie)
+                copy["domain"] = domain
+                jar.set_cookie(_cookie_from_dict(copy))
+
+    def _post_api_command(self, host, request, stream, headers):
+        """
+        Sends an API command to a server once. See :meth:`_send_api_command`.
+
+        """
+
+        request = copy.copy(request)
+
+         # Extract any files
+        file_args = {}
+        for i in (k for k, v in request.items() if isinstance(v, file)):
+            file_args[str(i)] = request.pop(i)
+
+        if not file_args:
+            return self.requests_session.post(
+                host.call_url,
+                data = utils.to_json(request),
+                headers = dict(
+                    self.transport.json_headers, **(headers or {})
+                ),
+                stream = stream,
+                verify = self.transport.verify
+            )
+
+        import multipart
+
+        # Stream the files up rather than building the whole body in memory
+        # first.
+        body = multipart.MultipartEncoder(
+            [("request", utils.to_json(request))],
+            sorted(file_args.items()),
+            progress = ui.progress_printer("Uploading files.")
+        )
+        try:
+            return self.requests_session.post(
+                host.call_url,
+                data = body,
+                headers = dict(
+                    headers or {},
+                    **{"Content-Type": body.content_type}
+                ),
+                stream = stream,
+                verify = self.transport.verify
+            )
+        finally:
+            # Don't leave the progress bar behind the response.
+            ui.print_carriage("")
+
+    def download(self, url, file_name, progress = None):
         """
         Downloads a file from Galah.
 
         :param url: The URL of the resource.
         :param file_name: The name of the file. Galah will supply this with a
                 custom HTTP header.
+        :param progress: A function that will be called as
+                ``progress(downloaded, size)`` as the file is written, where
+                ``size`` is ``0`` if it is unknown.
+        :returns: The path the file was saved to.
 
         """
 
         try:
-            return self._download(url, file_name)
+            with timings.record("download of %s" % (file_name, )):
+                return self._download(url, file_name, progress)
         except KeyboardInterrupt:
-            print "\rDownload cancelled by you." + " " * 40
+            print >> ui.output(), "\rDownload cancelled by you." + " " * 40
+            print >> ui.output(), \
+                "Run the command again to resume the download."
             sys.exit(1)
 
-    def _download(self, url, file_name):
+    def _download(self, url, file_name, progress = None):
         """
         See :meth:`download`.
 
@@ -622,89 +1571,509 @@ class APIClientSession:
                 downloads_directory
             )
 
-        # Find an available file path
-        final_file_path = utils.find_available_file(
-            os.path.join(downloads_directory, file_name)
+        part = _claim_partial_download(
+            os.path.join(downloads_directory, file_name), url
         )
-        final_file_name = os.path.basename(final_file_path)
+        try:
+            logger.debug("File will be downloaded to %s.", part.path)
+
+            # If the connection fails part of the way through, ask for the
+            # rest of the file.
+            try:
+                self.retry_policy.call(
+                    lambda: self._receive_download(url, part, progress),
+                    True, "the download"
+                )
+            except DownloadInterrupted as e:
+                # What we did receive is kept in the .part file.
+                logger.critical(
+                    "%s Run the command again to resume the download.",
+                    str(e)
+                )
+                sys.exit(1)
+
+            # Find an available file path and move the finished file there.
+            with _download_path_lock:
+                final_file_path = utils.find_available_file(
+                    os.path.join(downloads_directory, file_name)
+                )
+                part.finish(final_file_path)
+        finally:
+            with _download_path_lock:
+                _active_partial_downloads.discard(part.path)
+
+        print >> ui.output(), \
+            "File saved to %s." % utils.shorten_path(final_file_path)
+
+        return final_file_path
+
+    def _receive_download(self, url, part, progress = None):
+        """
+        Asks the server for the part of a file we don't have yet and writes
+        it to a partial download.
+
+        :param part: The :class:`downloads.PartialDownload` to write to.
+        :param progress: See :meth:`download`.
+        :returns: The response the server sent.
+        :raises DownloadInterrupted: If the file couldn't be received in
+                full. What was received is kept in ``part``.
+
+        """
+
+        file_request = self._poll_download(url, part.resume_headers())
+
+        logger.debug(
+            "Response headers...\n%s",
+            pprint.pformat(file_request.headers, width = 72)
+        )
+
+        if file_request.status_code == requests.codes.partial_content:
+            if _content_range_start(file_request) != part.written:
+                # We can't use what the server sent us, ask for all of it.
+                logger.info("Server sent the wrong range, restarting.")
+                file_request.close()
+                part.restart()
+                file_request = self._poll_download(url)
+            else:
+                logger.info(
+                    "Resuming download from %s.",
+                    utils.shorten_path(part.path)
+                )
 
-        logger.debug("File will be saved to %s.", final_file_path)
+        if file_request.status_code == requests.codes.ok:
+            if part.written:
+                logger.info(
+                    "Server sent the entire file, restarting download."
+                )
+            part.restart(file_request.headers.get("ETag"))
+
+        segments = _plan_segments(file_request)
+        if segments:
+            # We'll fetch the file piece by piece instead.
+            file_request.close()
+            self._write_download_segmented(url, part, segments, progress)
+        else:
+            self._write_download(file_request, part, progress)
+
+        return file_request
+
+    @timings.timed("download-poll")
+    def _poll_download(self, url, headers = None):
+        """
+        Asks the server for a file until it is ready to give it to us.
+
+        The server may need some time to prepare the file, so we back off
+        exponentially (with some random jitter) between attempts, or wait as
+        long as the server says to if it sends a ``Retry-After`` header. We give
+        up after ``download-max-wait`` seconds.
+
+        :param url: The URL of the resource.
+        :param headers: Any extra headers to send, such as those returned by
+                :meth:`downloads.PartialDownload.resume_headers`.
+        :returns: A streaming ``requests.Response`` with a 200 status code, or
+                a 206 status code if a range was requested.
+
+        """
+
+        headers = dict(headers or {})
 
         # Get a generator function that makes a pretty progress bar.
         bar = ui.progress_bar_indeterminate()
 
-        # Actually try to grab the file from the server
+        delays = utils.backoff_delays(
+            config.CONFIG["download-poll-interval"],
+            config.CONFIG["download-poll-max-interval"]
+        )
+
+        max_wait = config.CONFIG["download-max-wait"]
+        started = time.time()
+
         while True:
             ui.print_carriage(
                 "%s Trying to download file... %s" %
                     (ui.progress_bar(0.0), " " * 30)
             )
 
-            # Ask the server for the file
+            retry_after = None
+
+            def send():
+                return self.requests_session.get(
+                    url, timeout = DOWNLOAD_POLL_TIMEOUT, stream = True,
+                    headers = headers, verify = self.transport.verify
+                )
+
+            # Ask the server for the file. Timeouts and dropped connections
+            # are retried, and if that doesn't help we give up rather than
+            # polling a server that isn't there.
             try:
-                file_request = self.requests_session.get(
-                    url, timeout = 1, stream = True, verify = _get_verify()
+                file_request = self.retry_policy.call(
+                    send, True, "the download request"
                 )
-            except requests.exceptions.Timeout:
-                logger.info(
-                    "Request timed out. Server did not accept connection after "
-                    "1 second."
+            except requests.exceptions.RequestException:
+                logger.critical(
+                    "Galah did not respond at %s.", url, exc_info = True
                 )
+                sys.exit(1)
+            else:
+                # If it's giving it to us...
+                if file_request.status_code in (requests.codes.ok,
+                        requests.codes.partial_content):
+                    return file_request
+
+                # If the server won't give us the range we asked for, ask for
+                # the whole thing instead.
+                if file_request.status_code == \
+                        requests.codes.requested_range_not_satisfiable:
+                    logger.info("Cannot resume download, restarting.")
+                    file_request.close()
+                    headers.pop("Range", None)
+                    headers.pop("If-Range", None)
+                    continue
+
+                # If the server got particularly angry at us...
+                if (file_request.status_code == 500 or
+                        file_request.headers.get("X-CallSuccess") == "False"):
+                    logger.critical(
+                        "500 response. The server encountered an error."
+                    )
+                    sys.exit(1)
 
-            # If it's giving it to us...
-            if file_request.status_code == 200:
-                logger.debug(
-                    "Response headers...\n%s",
-                    pprint.pformat(file_request.headers, width = 72)
+                retry_after = utils.parse_retry_after(
+                    file_request.headers.get("Retry-After")
                 )
 
-                if "content-length" in file_request.headers:
-                    size = float(file_request.headers["content-length"])
-                else:
-                    logger.info("File is of unknown size.")
+                # Read the (small) body so the connection is returned to the
+                # pool and can be reused for the next attempt.
+                file_request.content
 
-                    size = 0
-                    ui.print_carriage(
-                        ui.progress_bar(-1) + " Downloading file."
-                    )
-
-                # Download the file in chunks.
-                chunk_size = 124
-                downloaded = 0
-                with open(final_file_path, "wb") as f:
-                    for chunk in file_request.iter_content(124):
-                        if size != 0:
-                            ui.print_carriage(
-                                ui.progress_bar(downloaded / size) +
-                                " Downloading file."
-                            )
-                            downloaded += chunk_size
+            delay = next(delays) if retry_after is None else retry_after
 
-                        f.write(chunk)
-
-            # If the server got particularly angry at us...
-            if (file_request.status_code == 500 or
-                    ("X-CallSuccess" in file_request.headers and
-                    file_request.headers["X-CallSuccess"] == "False")):
+            waited = time.time() - started
+            if max_wait and waited + delay > max_wait:
                 logger.critical(
-                    "500 response. The server encountered an error."
+                    "The server did not make the file available within %d "
+                    "seconds. Giving up.", max_wait
                 )
                 sys.exit(1)
 
-            if file_request.status_code == requests.codes.ok:
-                break
-
-            # Make sure that the trying prompt appears for at least a moment or
-            # so
-            time.sleep(0.5)
+            logger.debug("Download not ready, waiting %.1f seconds.", delay)
 
+            # Keep the spinner moving while we wait.
             period = 0.1
-            wait_for = 4
-            for i in xrange(int(wait_for / period)):
+            wait_until = time.time() + delay
+            while time.time() < wait_until:
                 ui.print_carriage(
                     next(bar) + " Download not ready yet. Waiting."
                 )
 
-                time.sleep(period)
+                time.sleep(min(period, max(0, wait_until - time.time())))
+
+    @timings.timed("download")
+    def _write_download(self, file_request, part, progress = None):
+        """
+        Writes the body of a streamed response to a partial download,
+        displaying a progress bar as it goes.
+
+        :param file_request: A ``requests.Response`` created with
+                ``stream = True``. If it is a 206 response, its body is
+                appended to what has already been written.
+        :param part: The :class:`downloads.PartialDownload` to write to. How
+                much has been written is recorded as we go so the download can
+                be resumed if it's interrupted.
+        :param progress: See :meth:`download`.
+        :returns: The number of bytes in the file.
+        :raises DownloadInterrupted: If receiving the body failed or it wasn't
+                the length the server said it would be. What was received is
+                kept in ``part``.
+
+        """
+
+        downloaded = part.written
+
+        size = int(file_request.headers.get("content-length", 0))
+        if size:
+            size += downloaded
+        else:
+            logger.info("File is of unknown size.")
+            ui.print_carriage(ui.progress_bar(-1) + " Downloading file.")
+
+        # The content-length only tells us the size of the file on disk if the
+        # server didn't compress it for transfer.
+        if "content-encoding" in file_request.headers:
+            preallocate = 0
+        else:
+            preallocate = size
+
+        last_percent = None
+        last_checkpoint = time.time()
+        last_checkpoint_written = downloaded
+        with open(part.path, "r+b" if downloaded else "wb") as f:
+            try:
+                f.seek(downloaded)
+                if preallocate:
+                    _preallocate(f, preallocate)
+
+                try:
+                    chunks = file_request.iter_content(
+                        config.CONFIG["download-chunk-size"]
+                    )
+                    for chunk in chunks:
+                        f.write(chunk)
+                        downloaded += len(chunk)
+                        part.written = downloaded
+
+                        if progress is not None:
+                            progress(downloaded, size)
+
+                        # Only redraw the progress bar when it would actually
+                        # change.
+                        if size:
+                            percent = downloaded * 100 // size
+                            if percent != last_percent:
+                                ui.print_carriage(
+                                    ui.progress_bar(downloaded / float(size)) +
+                                    " Downloading file."
+                                )
+                                last_percent = percent
+
+                        if time.time() - last_checkpoint > 1 or \
+                                downloaded - last_checkpoint_written >= \
+                                    DOWNLOAD_CHECKPOINT_SIZE:
+                            f.flush()
+                            part.save()
+                            last_checkpoint = time.time()
+                            last_checkpoint_written = downloaded
+                except (requests.exceptions.RequestException, socket.error,
+                        httplib.HTTPException) as e:
+                    # The connection failed part of the way through.
+                    raise DownloadInterrupted(downloaded, size, e)
+
+                # Only a body that wasn't compressed for transfer can be
+                # checked against the content-length. Anything else we
+                # received is left as is, so it can be resumed.
+                if preallocate and downloaded != size:
+                    raise DownloadInterrupted(downloaded, size)
+
+                # Remove any preallocated space we didn't need.
+                f.truncate(downloaded)
+            finally:
+                f.flush()
+                part.save()
+
+        return downloaded
+
+    @timings.timed("download")
+    def _write_download_segmented(self, url, part, segments, progress = None):
+        """
+        Downloads a file in several pieces at once, each over its own
+        connection, writing each piece directly into its place in the partial
+        download.
+
+        :param url: The URL of the resource.
+        :param part: The :class:`downloads.PartialDownload` to write to. Only
+                complete files are recorded as written, so a segmented download
+                that is interrupted will start over.
+        :param segments: A list of ``(start, end)`` tuples giving the
+                inclusive byte range of each piece, as returned by
+                :func:`_plan_segments`.
+        :param progress: See :meth:`download`.
+        :returns: The number of bytes in the file.
+
+        """
+
+        size = segments[-1][1] + 1
+
+        logger.info(
+            "Downloading file in %d segments of about %.1f MB.",
+            len(segments), size / (len(segments) * 1024.0 * 1024)
+        )
+
+        with open(part.path, "wb") as f:
+            _preallocate(f, size)
+
+        # The number of bytes written for each segment.
+        written = [0] * len(segments)
+        errors = []
+
+        headers = {}
+        if part.etag:
+            # Make sure every piece comes from the same version of the file.
+            headers["If-Range"] = part.etag
+
+        def fetch(index, start, end):
+            try:
+                segment_headers = dict(headers)
+                segment_headers["Range"] = "bytes=%d-%d" % (start, end)
+
+                r = self.retry_policy.call(
+                    lambda: self.requests_session.get(
+                        url, stream = True, headers = segment_headers,
+                        verify = self.transport.verify
+                    ),
+                    True, "bytes %d-%d of the download" % (start, end)
+                )
+                try:
+                    if r.status_code != requests.codes.partial_content or \
+                            _content_range_start(r) != start:
+                        raise IOError(
+                            "Expected bytes %d-%d, got a %d response." %
+                                (start, end, r.status_code)
+                        )
+
+                    with open(part.path, "r+b") as segment_file:
+                        segment_file.seek(start)
+
+                        chunks = r.iter_content(
+                            config.CONFIG["download-chunk-size"]
+                        )
+                        for chunk in chunks:
+                            if written[index] + len(chunk) > end - start + 1:
+                                raise IOError(
+                                    "Server sent too much data for bytes "
+                                    "%d-%d." % (start, end)
+                                )
+
+                            segment_file.write(chunk)
+                            written[index] += len(chunk)
+                finally:
+                    # Give the connection back to the pool, even if we
+                    # didn't read all of the body.
+                    r.close()
+            except (IOError, requests.exceptions.RequestException,
+                    httplib.HTTPException) as e:
+                logger.debug(
+                    "Could not download bytes %d-%d.", start, end,
+                    exc_info = True
+                )
+                errors.append(e)
+
+        workers = []
+        for index, (start, end) in enumerate(segments):
+            worker = threading.Thread(
+                target = fetch, args = (index, start, end)
+            )
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+        # Wait for the segments while keeping the progress bar up to date. We
+        # don't block on join() without a timeout so that KeyboardInterrupts
+        # can get through.
+        while any(i.is_alive() for i in workers):
+            downloaded = sum(written)
+            if progress is not None:
+                progress(downloaded, size)
+            ui.print_carriage(
+                ui.progress_bar(downloaded / float(size)) +
+                " Downloading file."
+            )
+
+            for i in workers:
+                i.join(0.1)
+
+        downloaded = sum(written)
+        if errors or downloaded != size:
+            logger.critical(
+                "Could not download file, received %d of %d bytes. %s",
+                downloaded, size, errors[0] if errors else ""
+            )
+            sys.exit(1)
+
+        if progress is not None:
+            progress(downloaded, size)
+
+        part.written = downloaded
+        part.save()
+
+        return downloaded
+
+class CallError(Exception):
+    """
+    Raised when retrieving the result of a command executed through an
+    :class:`AsyncAPIClientSession` that failed.
+
+    :ivar exit_status: The exit status the command failed with.
+    :ivar output: Everything the command printed or logged.
+
+    """
+
+    def __init__(self, exit_status, output):
+        Exception.__init__(self, exit_status, output)
+        self.exit_status = exit_status
+        self.output = output
+
+    def __str__(self):
+        return "Command failed with exit status %d.\n%s" % (
+            self.exit_status, self.output
+        )
+
+class AsyncAPIClientSession(APIClientSession):
+    """
+    An API client session whose methods return immediately.
+
+    :meth:`login`, :meth:`fetch_api_info`, :meth:`call` and :meth:`download`
+    are executed on a pool of worker threads, and each returns an
+    ``AsyncResult`` (see ``multiprocessing.pool``) whose ``get()`` method
+    blocks until the operation is complete. Output is captured rather than
+    printed, and ``get()`` returns the captured output, or raises a
+    :class:`CallError` if the operation failed.
+
+    The session is saved and loaded exactly like an :class:`APIClientSession`
+    so the two may be used interchangeably.
+
+    .. code-block:: python
+
+        session = AsyncAPIClientSession(jobs = 16)
+        session.load()
+        results = [session.call("get_archive", i) for i in assignments]
+        for i in results:
+            print i.get()
+
+    """
+
+    def __init__(self, jobs = None, *args, **kwargs):
+        APIClientSession.__init__(self, *args, **kwargs)
+
+        if jobs is None:
+            jobs = config.CONFIG["jobs"]
+
+        import multiprocessing.pool
+        self.pool = multiprocessing.pool.ThreadPool(max(1, jobs))
+
+    def _submit(self, func, *args, **kwargs):
+        def run():
+            exit_status, output, _ = ui.run_captured(func, *args, **kwargs)
+            if exit_status != 0:
+                raise CallError(exit_status, output)
+
+            return output
+
+        return self.pool.apply_async(run)
+
+    def login(self, email, password):
+        return self._submit(APIClientSession.login, self, email, password)
+
+    def fetch_api_info(self, revalidate = False):
+        return self._submit(
+            APIClientSession.fetch_api_info, self, revalidate
+        )
+
+    def call(self, command, *args, **kwargs):
+        return self._submit(
+            APIClientSession.call, self, command, *args, **kwargs
+        )
+
+    def download(self, url, file_name, progress = None):
+        return self._submit(
+            APIClientSession.download, self, url, file_name, progress
+        )
+
+    def close(self):
+        """
+        Waits for any outstanding operations to complete and then stops the
+        worker threads.
+
+        """
 
-        print "File saved to %s." % utils.shorten_path(final_file_path)
+        self.pool.close()
+        self.pool.join()
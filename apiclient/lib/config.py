@@ -76,7 +76,11 @@ __option_list = [
         "host", required = True,
         description =
             "The URL where a running Galah instance is available. For example: "
-            "'https://www.mygalahinstance.edu'."
+            "'https://www.mygalahinstance.edu'. If Galah is running on "
+            "several servers that share their sessions, give all of their "
+            "URLs separated by commas (or as a list in the configuration "
+            "file). Requests then go to whichever server is responding best, "
+            "and to another if one can't be reached."
     ),
     ConfigOption(
         "session-path", default_value = "~/.cache/galah/session",
@@ -87,6 +91,14 @@ __option_list = [
             "impersonate you, so be careful. If any directories are missing "
             "from the path they will be created."
     ),
+    ConfigOption(
+        "agent-socket-path", default_value = "~/.cache/galah/agent.sock",
+        data_type = Path,
+        description =
+            "The location of the socket an agent started with --agent "
+            "listens on. Commands are sent to the agent whenever one is "
+            "listening there."
+    ),
     ConfigOption(
         "api-info-path", default_value = "~/.cache/galah/api-info",
         data_type = Path,
@@ -95,6 +107,13 @@ __option_list = [
             "all of the commands the server supports and is automatically "
             "updated by the API client."
     ),
+    ConfigOption(
+        "api-info-ttl", default_value = 24 * 60 * 60,
+        description =
+            "The number of seconds the API info cache is used for before the "
+            "server is asked whether it has changed. Set to 0 to only check "
+            "when a command that isn't in the cache is used."
+    ),
     ConfigOption(
         "ca-certs-path", default_value = "~/.cache/galah/ca_certs",
         data_type = Path,
@@ -111,12 +130,194 @@ __option_list = [
             "The directory to place downloads from the server into. It will "
             "not be created if it does not exist."
     ),
+    ConfigOption(
+        "download-chunk-size", default_value = 256 * 1024,
+        description =
+            "The number of bytes to read from the network and write to disk "
+            "at a time when downloading a file. Larger chunks are a little "
+            "faster on very fast networks, but a chunk that was only partly "
+            "received when a download is interrupted is lost, and has to be "
+            "fetched again when the download is resumed."
+    ),
+    ConfigOption(
+        "download-workers", default_value = 4,
+        description =
+            "The number of files to download at once when commands are run "
+            "in batch mode or from the shell, where downloads happen in the "
+            "background."
+    ),
+    ConfigOption(
+        "download-segments", default_value = 1,
+        description =
+            "The number of pieces to split a large file into and download at "
+            "once, each over its own connection. This is only done if the "
+            "server supports it. Set to 1 to download files in one piece."
+    ),
+    ConfigOption(
+        "download-min-segment-size", default_value = 8 * 1024 * 1024,
+        description =
+            "The smallest piece, in bytes, a file will be split into when "
+            "downloading it in several pieces (see download-segments)."
+    ),
+    ConfigOption(
+        "download-poll-interval", default_value = 0.5,
+        description =
+            "The number of seconds to wait before asking the server again for "
+            "a file it is still preparing. This doubles with each attempt."
+    ),
+    ConfigOption(
+        "download-poll-max-interval", default_value = 8.0,
+        description =
+            "The longest number of seconds to wait between asking the server "
+            "for a file it is still preparing."
+    ),
+    ConfigOption(
+        "download-max-wait", default_value = 3600,
+        description =
+            "The number of seconds to wait for the server to prepare a file "
+            "before giving up. Set to 0 to wait forever."
+    ),
+    ConfigOption(
+        "cache-commands",
+        description =
+            "The commands whose responses may be cached and reused for "
+            "cache-ttl seconds, separated by commas (or a list in the "
+            "configuration file). Only list commands that don't change "
+            "anything on the server. Nothing is cached by default."
+    ),
+    ConfigOption(
+        "cache-ttl", default_value = 300,
+        description =
+            "The number of seconds a cached response is used for (see "
+            "cache-commands)."
+    ),
+    ConfigOption(
+        "cache-path", default_value = "~/.cache/galah/responses/",
+        data_type = Path,
+        description =
+            "The directory cached responses are kept in (see "
+            "cache-commands). Anyone who can read it can see the responses, "
+            "so be careful."
+    ),
+    ConfigOption(
+        "cache-max-size", default_value = 50 * 1024 * 1024,
+        description =
+            "The most bytes the cached responses may take up. The least "
+            "recently used responses are removed when there are more."
+    ),
+    ConfigOption(
+        "coalesce-commands",
+        description =
+            "The commands that, when the same call is made more than once at "
+            "the same time (for example by several jobs in batch mode), "
+            "should only be sent to the server once, with every caller "
+            "getting the same response. Separated by commas (or a list in "
+            "the configuration file). Only list commands that don't change "
+            "anything on the server."
+    ),
     ConfigOption(
         "verbosity", default_value = "INFO",
         description =
             "The desired logging level. Choices are %s." %
                 (", ".join(logcontrol.LOG_LEVELS), )
     ),
+    ConfigOption(
+        "pool-connections", default_value = 4,
+        description =
+            "The number of hosts to keep pooled connections open to."
+    ),
+    ConfigOption(
+        "pool-maxsize", default_value = 10,
+        description =
+            "The maximum number of connections to keep open to any one host. "
+            "This is raised to the value of jobs if that is larger."
+    ),
+    ConfigOption(
+        "max-retries", default_value = 0,
+        description =
+            "The number of times to retry a request that failed because a "
+            "connection to the server could not be made."
+    ),
+    ConfigOption(
+        "retry-attempts", default_value = 4,
+        description =
+            "The most times to send a request that failed for a reason that "
+            "may go away on its own, such as a dropped connection or a 503 "
+            "response. Commands that might change something on the server "
+            "are only sent again if the server can't have acted on them "
+            "(see idempotent-commands). Set to 1 to never try again."
+    ),
+    ConfigOption(
+        "retry-initial-delay", default_value = 0.5,
+        description =
+            "The number of seconds to wait before the first retry. This "
+            "doubles with each attempt, and some randomness is added."
+    ),
+    ConfigOption(
+        "retry-max-delay", default_value = 8.0,
+        description = "The longest number of seconds to wait between retries."
+    ),
+    ConfigOption(
+        "retry-deadline", default_value = 60.0,
+        description =
+            "The number of seconds after a request is first sent that it "
+            "won't be tried again. Set to 0 for no limit."
+    ),
+    ConfigOption(
+        "idempotent-commands",
+        description =
+            "The commands that may be sent again after any temporary "
+            "failure, because running them twice does no harm. Separated by "
+            "commas (or a list in the configuration file). Commands listed "
+            "in cache-commands or coalesce-commands are included "
+            "automatically."
+    ),
+    ConfigOption(
+        "no-keep-alive", default_value = False,
+        description =
+            "If set, connections to the server will be closed after each "
+            "request rather than being kept open and reused."
+    ),
+    ConfigOption(
+        "rate-limit", default_value = 0.0,
+        description =
+            "The most commands per second to send to a host. Set to 0 for no "
+            "limit."
+    ),
+    ConfigOption(
+        "rate-burst", default_value = 5,
+        description =
+            "The number of commands that may be sent at once, before "
+            "rate-limit kicks in, after the client has been idle."
+    ),
+    ConfigOption(
+        "max-concurrency", default_value = 0,
+        description =
+            "The most commands to have in progress on a host at once. The "
+            "limit is lowered automatically while the server is responding "
+            "slowly or with errors, and raised again once it recovers. Set "
+            "to 0 for no limit."
+    ),
+    ConfigOption(
+        "latency-tolerance", default_value = 2.0,
+        description =
+            "How many times longer than usual the server may take to respond "
+            "before max-concurrency is lowered."
+    ),
+    ConfigOption(
+        "host-limits", data_type = dict,
+        description =
+            "Different values of rate-limit, rate-burst, max-concurrency and "
+            "latency-tolerance for particular hosts, as a dictionary mapping "
+            "each host to its options. Can only be set in the configuration "
+            "file."
+    ),
+    ConfigOption(
+        "jobs", default_value = 4,
+        description =
+            "The number of commands to execute concurrently when running in "
+            "batch mode (see --batch)."
+    ),
     ConfigOption(
         "show-tracebacks", default_value = False,
         description =
@@ -195,6 +396,80 @@ def parse_arguments(args = sys.argv[1:]):
                 "interactive shell where you can execute API commands more "
                 "conveniently."
         ),
+        make_option(
+            "--batch", "-b", metavar = "FILE",
+            help =
+                "If set, after signing in each line of FILE will be executed "
+                "as a command, as if it had been typed into the shell. Use - "
+                "to read commands from standard input. A summary of which "
+                "commands succeeded is printed once every command has run."
+        ),
+        make_option(
+            "--bulk", metavar = "DIRECTORY",
+            help =
+                "If set, the command given is treated as a template and "
+                "executed once for every file in DIRECTORY and its "
+                "subdirectories. Fields such as {path}, {relpath}, {name} and "
+                "{parts[0]} in the command are replaced with details of each "
+                "file. Completed commands are recorded in a manifest so they "
+                "are skipped if the same command is run again."
+        ),
+        make_option(
+            "--bulk-pattern", metavar = "PATTERN", dest = "bulk-pattern",
+            default = "*",
+            help =
+                "Only use files in the --bulk directory whose names match this "
+                "shell-style wildcard pattern. [Default: *]"
+        ),
+        make_option(
+            "--bulk-manifest", metavar = "FILE", dest = "bulk-manifest",
+            help =
+                "Where to keep the manifest of completed commands when using "
+                "--bulk. [Default: a file named .galah-bulk-manifest in the "
+                "--bulk directory]"
+        ),
+        make_option(
+            "--agent", action = "store_true",
+            help =
+                "If set, after signing in an agent will be started that "
+                "keeps the session, its connections to the server and the "
+                "API info loaded. Commands given to the API client while the "
+                "agent is running are executed by the agent, which is much "
+                "faster than starting from scratch. The agent runs until it "
+                "is interrupted or --stop-agent is used."
+        ),
+        make_option(
+            "--stop-agent", action = "store_true", dest = "stop-agent",
+            help =
+                "If set, the running agent (see --agent) will be stopped and "
+                "then the script will exit immediately."
+        ),
+        make_option(
+            "--no-agent", action = "store_true", dest = "no-agent",
+            help =
+                "If set, the command will be executed by this process even if "
+                "an agent is running."
+        ),
+        make_option(
+            "--no-cache", action = "store_true", dest = "no-cache",
+            help =
+                "If set, no cached responses will be used or saved (see the "
+                "cache-commands option)."
+        ),
+        make_option(
+            "--timings", action = "store_true",
+            help =
+                "If set, a breakdown of where the time went (such as loading "
+                "files, connecting, and waiting on the server) will be "
+                "printed to standard error after starting up and after each "
+                "command."
+        ),
+        make_option(
+            "--timings-file", metavar = "FILE", dest = "timings-file",
+            help =
+                "If set, the same breakdown as --timings gives will be "
+                "appended to FILE as one line of JSON per command."
+        ),
         make_option(
             "--save", action = "store_true",
             help =
@@ -207,11 +482,19 @@ def parse_arguments(args = sys.argv[1:]):
 
     # Go through the configuration options and map them to command line options
     for i in KNOWN_OPTIONS.values():
+        # There's no sensible way to give these on the command line.
+        if i.data_type is dict:
+            continue
+
+        option_type = None
         if i.data_type is bool:
             action = "store_false" if i.default_value == True else "store_true"
         else:
             action = "store"
 
+            if i.data_type in (int, float):
+                option_type = i.data_type.__name__
+
         required_string = ""
         if i.required:
             required_string = (
@@ -224,7 +507,7 @@ def parse_arguments(args = sys.argv[1:]):
             default_string = " [Default: %s]" % (str(i.default_value), )
 
         option_list.append(make_option(
-            "--" + i.name, action = action, dest = i.name,
+            "--" + i.name, action = action, dest = i.name, type = option_type,
             help = i.description + required_string + default_string
         ))
 
@@ -238,6 +521,19 @@ def parse_arguments(args = sys.argv[1:]):
 
     return (options, args)
 
+def command_set(name):
+    """
+    Returns the set of commands named by a configuration option, which may be
+    a list or a string of names separated by commas.
+
+    """
+
+    commands = CONFIG.get(name) or []
+    if isinstance(commands, basestring):
+        commands = commands.split(",")
+
+    return set(str(i).strip() for i in commands if str(i).strip())
+
 def dump_config():
     """
     Serailizes configuration into YAML and returns the result as a string.
@@ -251,6 +547,80 @@ def dump_config():
 
     return utils.yaml_module().safe_dump(config)
 
+#: The directory where snapshots of parsed configuration files are kept.
+SNAPSHOT_DIRECTORY = "~/.cache/galah/"
+
+def _snapshot_path(config_file_path):
+    import hashlib
+
+    name = hashlib.sha1(os.path.abspath(config_file_path)).hexdigest()[:16]
+    return os.path.join(
+        utils.resolve_path(SNAPSHOT_DIRECTORY), "config-%s.compiled" % (name, )
+    )
+
+def load_config_file(config_file_path):
+    """
+    Loads a configuration file.
+
+    Importing a YAML library and parsing the file takes longer than the
+    rest of starting up, so a snapshot of the parsed file is saved in
+    :data:`SNAPSHOT_DIRECTORY` and used until the file changes.
+
+    :returns: A ``dict``.
+
+    """
+
+    import apicache
+
+    snapshot_path = _snapshot_path(config_file_path)
+    configuration = apicache.load_snapshot(config_file_path, snapshot_path)
+    if isinstance(configuration, dict):
+        return configuration
+
+    try:
+        f = open(config_file_path)
+    except IOError:
+        logger.critical(
+            "Could not open configuration file at %s.",
+            config_file_path,
+            exc_info = sys.exc_info()
+        )
+        raise
+
+    try:
+        raw = f.read()
+        configuration = utils.load_yaml(raw)
+
+        if not isinstance(configuration, dict):
+            logger.critical(
+                "Your configuration file is not properly formatted. "
+                "The top level item must be a dictionary."
+            )
+            sys.exit(1)
+    except ValueError:
+        logger.critical(
+            "Could not parse configuration file at %s.",
+            config_file_path,
+            exc_info = sys.exc_info()
+        )
+        raise
+    finally:
+        f.close()
+
+    try:
+        utils.prepare_directory(os.path.dirname(snapshot_path))
+    except OSError:
+        logger.debug(
+            "Could not create %s.", os.path.dirname(snapshot_path),
+            exc_info = True
+        )
+    else:
+        apicache.save_snapshot(
+            config_file_path, raw, configuration, snapshot_path
+        )
+
+    return configuration
+
 def load_config():
     """
     Loads the configuration and parses the command line arguments.
@@ -308,35 +678,7 @@ def load_config():
         logger.info("No configuration file found.")
     else:
         logger.info("Loading configuration file at %s.", config_file_path)
-
-        try:
-            f = open(config_file_path)
-        except IOError:
-            logger.critical(
-                "Could not open configuration file at %s.",
-                config_file_path,
-                exc_info = sys.exc_info()
-            )
-            raise
-
-        try:
-            configuration = utils.load_yaml(f)
-
-            if not isinstance(configuration, dict):
-                logger.critical(
-                    "Your configuration file is not properly formatted. "
-                    "The top level item must be a dictionary."
-                )
-                sys.exit(1)
-        except ValueError:
-            logger.critical(
-                "Could not parse configuration file at %s.",
-                config_file_path,
-                exc_info = sys.exc_info()
-            )
-            raise
-        finally:
-            f.close()
+        configuration = load_config_file(config_file_path)
 
     # Make a dictionary with the default values in it
     default_configuration = dict(
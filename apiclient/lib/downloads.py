@@ -0,0 +1,327 @@
+# Copyright (c) 2013 Galah Group LLC
+# Copyright (c) 2013 Other contributers as noted in the CONTRIBUTERS file
+#
+# This file is part of galah-apiclient.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This module handles downloading files from Galah in the background.
+
+"""
+
+import os
+import time
+import Queue
+import threading
+
+import ui
+import utils
+import pretty
+
+import logging
+logger = logging.getLogger("apiclient.downloads")
+
+class Download:
+    """
+    A file the server asked us to download.
+
+    :ivar url: The URL of the file.
+    :ivar file_name: The name the server suggested for the file.
+    :ivar downloaded: The number of bytes downloaded so far.
+    :ivar size: The size of the file in bytes, or ``0`` if it is unknown.
+    :ivar path: Where the file was saved to. ``None`` until it has been saved.
+    :ivar output: Everything that was printed or logged while downloading the
+            file. ``None`` until the download has finished.
+    :ivar exit_status: ``0`` if the download succeeded, otherwise a non-zero
+            integer. ``None`` until the download has finished.
+
+    """
+
+    def __init__(self, url, file_name):
+        self.url = url
+        self.file_name = file_name
+        self.downloaded = 0
+        self.size = 0
+        self.path = None
+        self.output = None
+        self.exit_status = None
+
+    @property
+    def finished(self):
+        return self.exit_status is not None
+
+    @property
+    def succeeded(self):
+        return self.exit_status == 0
+
+    def __str__(self):
+        return "download of %s" % (self.file_name, )
+
+class PartialDownload:
+    """
+    A file that is in the process of being downloaded.
+
+    Data is written to a ``.part`` file next to where the file will end up.
+    Alongside it is a small metadata file recording where the data came from
+    and how much of it has been written, so that an interrupted download can
+    be resumed rather than started over.
+
+    :ivar path: The path of the ``.part`` file.
+    :ivar url: The URL the file is being downloaded from.
+    :ivar source_url: The URL the data already in the ``.part`` file came
+            from.
+    :ivar etag: The ETag the server sent along with the data already in the
+            ``.part`` file, if any.
+    :ivar written: The number of bytes in the ``.part`` file that are known to
+            be good.
+
+    """
+
+    SUFFIX = ".part"
+    META_SUFFIX = ".part.meta"
+
+    def __init__(self, file_path, url):
+        self.path = file_path + PartialDownload.SUFFIX
+        self.meta_path = file_path + PartialDownload.META_SUFFIX
+        self.url = url
+        self.source_url = url
+        self.etag = None
+        self.written = 0
+
+    def load(self):
+        """
+        Loads the metadata saved by a previous attempt at this download, if
+        there was one.
+
+        """
+
+        if not os.path.isfile(self.path) or \
+                not os.path.isfile(self.meta_path):
+            return
+
+        try:
+            with open(self.meta_path, "rb") as f:
+                meta = utils.json_module().load(f)
+
+            written = int(meta["written"])
+            if written > os.path.getsize(self.path):
+                raise ValueError("Metadata claims more data than was saved.")
+
+            self.source_url = meta["url"]
+            self.etag = meta.get("etag")
+            self.written = written
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            logger.info(
+                "Ignoring unreadable partial download metadata at %s.",
+                self.meta_path, exc_info = True
+            )
+
+    def save(self):
+        """
+        Records how much of the file has been written so far.
+
+        """
+
+        temp_path = self.meta_path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(utils.to_json({
+                "url": self.source_url,
+                "etag": self.etag,
+                "written": self.written
+            }))
+        os.rename(temp_path, self.meta_path)
+
+    def resume_headers(self):
+        """
+        Returns the headers to send with a request for the file so that the
+        server only sends us what we don't already have. An empty dictionary is
+        returned if the download can't be resumed.
+
+        """
+
+        if not self.written:
+            return {}
+
+        headers = {"Range": "bytes=%d-" % (self.written, )}
+        if self.etag:
+            # The server will only honor the range if the file hasn't changed.
+            headers["If-Range"] = self.etag
+        elif self.source_url != self.url:
+            # We have no way of knowing if this is the same file.
+            return {}
+
+        return headers
+
+    def restart(self, etag = None):
+        """
+        Throws away anything already written, as the server is sending the
+        whole file again.
+
+        """
+
+        self.source_url = self.url
+        self.etag = etag
+        self.written = 0
+
+    def finish(self, final_path):
+        """
+        Moves the completed file to ``final_path`` and removes the metadata.
+
+        """
+
+        os.rename(self.path, final_path)
+
+        try:
+            os.remove(self.meta_path)
+        except OSError:
+            logger.debug(
+                "Could not remove %s.", self.meta_path, exc_info = True
+            )
+
+class DownloadManager:
+    """
+    Downloads files over a shared :class:`communicate.APIClientSession` using
+    a number of worker threads.
+
+    Downloads are added with :meth:`submit`, which returns immediately.
+
+    .. code-block:: python
+
+        manager = DownloadManager(session, 4)
+        session.download_manager = manager
+        session.call("get_archive", "cs100/lab1")
+        session.call("get_archive", "cs100/lab2")
+        manager.wait()
+
+    """
+
+    def __init__(self, session, workers):
+        self.session = session
+        self.downloads = []
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+
+        # Downloads that have finished but have not been returned by
+        # pop_finished() yet.
+        self._finished = []
+
+        for i in xrange(max(1, workers)):
+            worker = threading.Thread(target = self._work)
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, url, file_name):
+        """
+        Queues up a file to be downloaded.
+
+        :returns: A :class:`Download` object that will be updated as the file
+                is downloaded.
+
+        """
+
+        download = Download(url, file_name)
+        with self.lock:
+            self.downloads.append(download)
+        self.queue.put(download)
+
+        logger.debug("Queued download of %s from %s.", file_name, url)
+
+        return download
+
+    def _work(self):
+        while True:
+            download = self.queue.get()
+
+            def progress(downloaded, size):
+                download.downloaded = downloaded
+                download.size = size
+
+            exit_status, output, path = ui.run_captured(
+                self.session.download, download.url, download.file_name,
+                progress
+            )
+
+            with self.lock:
+                download.path = path
+                download.output = output
+                download.exit_status = exit_status
+                self._finished.append(download)
+
+            self.queue.task_done()
+
+    def pending(self):
+        """
+        Returns a list of downloads that have not finished yet.
+
+        """
+
+        with self.lock:
+            return [i for i in self.downloads if not i.finished]
+
+    def pop_finished(self):
+        """
+        Returns a list of downloads that have finished since the last time this
+        function was called.
+
+        """
+
+        with self.lock:
+            finished, self._finished = self._finished, []
+            return finished
+
+    def progress(self):
+        """
+        Returns a one-line summary of how the downloads are progressing.
+
+        """
+
+        with self.lock:
+            finished = len([i for i in self.downloads if i.finished])
+            total = len(self.downloads)
+            downloaded = sum(i.downloaded for i in self.downloads)
+            sizes = [i.size for i in self.downloads]
+
+        # We can only show how far along we are if we know the size of every
+        # file.
+        if sizes and all(sizes):
+            bar = ui.progress_bar(downloaded / float(sum(sizes)))
+        else:
+            bar = ui.progress_bar(-1)
+
+        return "%s %d of %d %s, %.1f MB downloaded." % (
+            bar, finished, total, pretty.plural_if("file", total),
+            downloaded / (1024.0 * 1024)
+        )
+
+    def wait(self):
+        """
+        Blocks until every download has finished, displaying a progress bar in
+        the meantime.
+
+        :returns: A list of every download that has been submitted.
+
+        """
+
+        while self.pending():
+            ui.print_carriage(self.progress())
+
+            # Sleep rather than join the queue so KeyboardInterrupts can get
+            # through.
+            time.sleep(0.1)
+
+        if self.downloads:
+            ui.print_carriage("")
+
+        with self.lock:
+            return self.downloads[:]
@@ -16,14 +16,17 @@
 # limitations under the License.
 
 """
-This module houses the useful :class:`Function` class.
+This module houses the useful :class:`Function` class, along with
+:class:`FunctionIndex` which holds all of the commands the server supports.
 
 """
 
+import marshal
+
 import logging
 logger = logging.getLogger("apiclient.function")
 
-class Function:
+class Function(object):
     """
     This class represents a command that can be executed on the server.
 
@@ -33,7 +36,9 @@ class Function:
 
     """
 
-    class Parameter:
+    class Parameter(object):
+        __slots__ = ("name", "param_type", "default_value")
+
         def __init__(self, name, default_value = None, param_type = None):
             self.name = str(name)
             self.param_type = param_type
@@ -56,6 +61,8 @@ class Function:
             else:
                 return "".join(result)
 
+    __slots__ = ("name", "params")
+
     def __init__(self, name, params):
         self.name = name
         self.params = params
@@ -126,3 +133,91 @@ class Function:
     def __str__(self):
         return self.name + " " + " ".join(str(i) for i in self.params)
 
+def compile_api_info(api_info):
+    """
+    Converts API info into the compact form a :class:`FunctionIndex` is built
+    from.
+
+    :param api_info: A list of dictionaries as returned by Galah.
+    :returns: A dictionary mapping each command's name to a marshalled tuple
+            of ``(name, default_value, takes_file)`` tuples describing its
+            parameters. Only builtin types are used so the result can itself
+            be marshalled.
+
+    """
+
+    compiled = {}
+    for command in api_info:
+        compiled[str(command["name"])] = marshal.dumps(tuple(
+            (
+                i["name"],
+                i.get("default_value"),
+                bool(i.get("takes_file", False))
+            ) for i in command.get("args", [])
+        ))
+
+    return compiled
+
+class FunctionIndex(object):
+    """
+    A read-only, dictionary-like mapping of command names to
+    :class:`Function` objects.
+
+    Each :class:`Function` is only built the first time it is looked up, so
+    the cost of loading the index doesn't depend on how many parameters every
+    other command has.
+
+    """
+
+    __slots__ = ("compiled", "_functions")
+
+    def __init__(self, compiled):
+        """
+        :param compiled: A dictionary as returned by :func:`compile_api_info`.
+
+        """
+
+        self.compiled = compiled
+        self._functions = {}
+
+    def __getitem__(self, name):
+        try:
+            return self._functions[name]
+        except KeyError:
+            pass
+
+        params = [
+            Function.Parameter(
+                name = param_name,
+                default_value = default_value,
+                param_type = file if takes_file else str
+            ) for param_name, default_value, takes_file in
+                marshal.loads(self.compiled[name])
+        ]
+
+        result = self._functions[name] = Function(name, params)
+        return result
+
+    def get(self, name, default = None):
+        if name in self.compiled:
+            return self[name]
+
+        return default
+
+    def __contains__(self, name):
+        return name in self.compiled
+
+    def __iter__(self):
+        return iter(self.compiled)
+
+    def __len__(self):
+        return len(self.compiled)
+
+    def keys(self):
+        return self.compiled.keys()
+
+    def values(self):
+        return [self[i] for i in self.compiled]
+
+    def items(self):
+        return [(i, self[i]) for i in self.compiled]
@@ -0,0 +1,223 @@
+# Copyright (c) 2013 Galah Group LLC
+# Copyright (c) 2013 Other contributers as noted in the CONTRIBUTERS file
+#
+# This file is part of galah-apiclient.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This module handles choosing which server to talk to when Galah is running on
+several servers (see the ``host`` option).
+
+Every request goes to the healthiest server we know of, judged by how quickly
+it has been responding and how often it has failed recently. To spread the
+load when many commands run at once (such as in batch mode), two servers are
+picked at random and the healthier one, taking into account how many commands
+each is already handling, is used. If a server can't be reached, the next
+healthiest is tried straight away, and the server is avoided for a while.
+
+"""
+
+import time
+import random
+import urlparse
+import threading
+
+import pretty
+
+import logging
+logger = logging.getLogger("apiclient.hostpool")
+
+#: How much weight each new measurement is given in a server's average
+#: response time and error rate.
+SMOOTHING = 0.3
+
+#: How strongly errors count against a server. A server that fails every
+#: request looks this many times slower than it really is.
+ERROR_PENALTY = 10
+
+#: The number of seconds a server that couldn't be reached is avoided for.
+COOLDOWN = 30
+
+def parse_hosts(value):
+    """
+    Returns the list of URLs given in the ``host`` option, which may be a
+    list or a string of URLs separated by commas.
+
+    """
+
+    if isinstance(value, basestring):
+        value = value.split(",")
+
+    return [str(i).strip() for i in value if str(i).strip()]
+
+def effective_domain(url):
+    """
+    Returns the domain the cookies a server sets are stored under, which is
+    what Python's ``cookielib`` calls the effective request host.
+
+    """
+
+    domain = (urlparse.urlparse(url).hostname or "").lower()
+    if "." not in domain:
+        domain += ".local"
+
+    return domain
+
+class Host(object):
+    """
+    A single server and how well it has been doing.
+
+    :ivar url: The URL of the server.
+    :ivar call_url: The URL API commands are sent to.
+    :ivar login_url: The URL logins are sent to.
+    :ivar latency: The average number of seconds the server has been taking
+            to respond, or ``None`` if it hasn't been used yet.
+    :ivar error_rate: The fraction of recent requests that failed, on
+            average.
+    :ivar in_flight: The number of requests waiting on the server.
+
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.call_url = urlparse.urljoin(url, "/api/call")
+        self.login_url = urlparse.urljoin(url, "/api/login")
+
+        self.latency = None
+        self.error_rate = 0.0
+        self.in_flight = 0
+        self.failed_at = None
+
+        self.requests = 0
+        self.failures = 0
+
+    def cost(self):
+        """
+        Returns how expensive it is expected to be to send this server
+        another request. Lower is better.
+
+        """
+
+        # Servers we don't know anything about yet look cheap so they get
+        # tried.
+        latency = self.latency or 0.0
+        return (latency * (1 + ERROR_PENALTY * self.error_rate) *
+            (1 + self.in_flight))
+
+    def cooling_down(self, now):
+        return self.failed_at is not None and now - self.failed_at < COOLDOWN
+
+    def __str__(self):
+        return self.url
+
+class HostPool(object):
+    """
+    The servers Galah is running on.
+
+    :ivar hosts: A list of :class:`Host` objects, in the order they were
+            configured.
+
+    """
+
+    def __init__(self, urls):
+        self.hosts = [Host(i) for i in urls]
+        self.lock = threading.Lock()
+
+    @property
+    def urls(self):
+        return [i.url for i in self.hosts]
+
+    def candidates(self):
+        """
+        Returns every host in the order they should be tried in.
+
+        :returns: A list of :class:`Host` objects.
+
+        """
+
+        if len(self.hosts) == 1:
+            return list(self.hosts)
+
+        now = time.time()
+        with self.lock:
+            ranked = sorted(
+                self.hosts,
+                key = lambda i: (i.cooling_down(now), i.cost())
+            )
+
+            healthy = [i for i in ranked if not i.cooling_down(now)]
+            if len(healthy) >= 2:
+                # The power of two choices: much better at spreading load
+                # than always using the best host, which would be
+                # overwhelmed while the others sit idle.
+                first, second = random.sample(healthy, 2)
+                choice = first if first.cost() <= second.cost() else second
+                ranked.remove(choice)
+                ranked.insert(0, choice)
+
+        return ranked
+
+    def started(self, host):
+        """
+        Records that a request is being sent to ``host``.
+
+        """
+
+        with self.lock:
+            host.in_flight += 1
+            host.requests += 1
+
+    def finished(self, host, latency, succeeded, reachable = True):
+        """
+        Records how a request sent to ``host`` went.
+
+        :param latency: The number of seconds the request took.
+        :param succeeded: ``False`` if the server failed to handle the request.
+        :param reachable: ``False`` if the server couldn't be reached at all.
+
+        """
+
+        with self.lock:
+            host.in_flight -= 1
+
+            error = 0.0 if succeeded else 1.0
+            host.error_rate += (error - host.error_rate) * SMOOTHING
+
+            if not succeeded:
+                host.failures += 1
+
+            if not reachable:
+                host.failed_at = time.time()
+            else:
+                host.failed_at = None
+                if host.latency is None:
+                    host.latency = latency
+                else:
+                    host.latency += (latency - host.latency) * SMOOTHING
+
+    def summary(self):
+        """
+        Returns a list of one-line descriptions of how each host has done.
+
+        """
+
+        with self.lock:
+            return [
+                "%s: %d %s, %d failed, %s" % (
+                    i.url, i.requests, pretty.plural_if("request", i.requests),
+                    i.failures,
+                    "no responses" if i.latency is None else
+                        "%.0fms average response" % (i.latency * 1000, )
+                ) for i in self.hosts
+            ]
@@ -22,6 +22,8 @@ standard library module.
 """
 
 import sys
+import threading
+import contextlib
 
 import pretty
 
@@ -64,10 +66,47 @@ class LogFormatter(logging.Formatter):
 
         return "".join(result)
 
+_redirect = threading.local()
+
+class LogHandler(logging.StreamHandler):
+    """
+    A stream handler that writes records to the stream given to
+    :func:`redirect` if one is in effect for the thread that emitted the
+    record.
+
+    """
+
+    def emit(self, record):
+        stream = getattr(_redirect, "stream", None)
+        if stream is None:
+            return logging.StreamHandler.emit(self, record)
+
+        try:
+            stream.write(self.format(record) + "\n")
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+@contextlib.contextmanager
+def redirect(stream):
+    """
+    A context manager that sends log records emitted by the current thread to
+    ``stream`` rather than standard error. Other threads are not affected.
+
+    """
+
+    old_stream = getattr(_redirect, "stream", None)
+    _redirect.stream = stream
+    try:
+        yield stream
+    finally:
+        _redirect.stream = old_stream
+
 def init_logging():
     """Set up the logger with default values."""
 
-    default_handler = logging.StreamHandler()
+    default_handler = LogHandler()
     default_handler.setFormatter(
         LogFormatter(fmt = "%(levelname)s - %(message)s")
     )
@@ -0,0 +1,204 @@
+# Copyright (c) 2013 Galah Group LLC
+# Copyright (c) 2013 Other contributers as noted in the CONTRIBUTERS file
+#
+# This file is part of galah-apiclient.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This module houses the :class:`MultipartEncoder` class, which is used to upload
+files without reading them into memory first.
+
+"""
+
+import os
+import uuid
+
+import logging
+logger = logging.getLogger("apiclient.multipart")
+
+class MultipartEncoder:
+    """
+    A file-like object that produces a ``multipart/form-data`` request body a
+    piece at a time, reading any files only as the body is sent.
+
+    Because the size of every part is known up front, the length of the body
+    is available (through ``len()``) before anything is read, so it can be sent
+    with a ``Content-Length`` rather than being buffered.
+
+    :ivar content_type: The value to send as the ``Content-Type`` header.
+
+    .. code-block:: python
+
+        encoder = MultipartEncoder(
+            [("request", '{"api_name": "upload"}')],
+            [("submission", open("main.cpp", "rb"))]
+        )
+        requests.post(
+            url, data = encoder,
+            headers = {"Content-Type": encoder.content_type}
+        )
+
+    """
+
+    def __init__(self, fields, files, chunk_size = 64 * 1024,
+            progress = None):
+        """
+        :param fields: A list of ``(name, value)`` tuples of plain form fields.
+        :param files: A list of ``(name, file)`` tuples where ``file`` is a
+                file object opened in binary mode. The file will be read from
+                its current position to its end.
+        :param chunk_size: The most data to read from a file at once.
+        :param progress: A function that will be called as
+                ``progress(sent, total)`` as the body is read.
+
+        """
+
+        self.boundary = uuid.uuid4().hex
+        self.content_type = \
+            "multipart/form-data; boundary=%s" % (self.boundary, )
+        self.chunk_size = chunk_size
+        self.progress = progress
+
+        # Each part is either a string or a (file, size) tuple.
+        self._parts = []
+        for name, value in fields:
+            self._parts.append(
+                self._header(name) + "\r\n" + _to_bytes(value) + "\r\n"
+            )
+        for name, f in files:
+            file_name = os.path.basename(getattr(f, "name", name))
+            self._parts.append(self._header(name, file_name) + "\r\n")
+            self._parts.append((f, _remaining_size(f)))
+            self._parts.append("\r\n")
+        self._parts.append("--%s--\r\n" % (self.boundary, ))
+
+        self.len = sum(
+            len(i) if isinstance(i, str) else i[1] for i in self._parts
+        )
+        self.sent = 0
+
+        # A string that has been read from a part but not returned yet.
+        self._buffer = ""
+
+    def _header(self, name, file_name = None):
+        disposition = 'form-data; name="%s"' % (_quote(name), )
+        if file_name is not None:
+            disposition += '; filename="%s"' % (_quote(file_name), )
+
+        return "--%s\r\nContent-Disposition: %s\r\n" % (
+            self.boundary, disposition
+        )
+
+    def __len__(self):
+        return self.len
+
+    def _next_chunk(self):
+        """
+        Returns the next piece of the body, or an empty string if there is
+        nothing left.
+
+        """
+
+        while self._parts:
+            part = self._parts[0]
+            if isinstance(part, str):
+                self._parts.pop(0)
+                return part
+
+            f, remaining = part
+            if not remaining:
+                # An empty file has nothing to read.
+                self._parts.pop(0)
+                continue
+
+            chunk = f.read(min(self.chunk_size, remaining))
+            if not chunk:
+                raise IOError(
+                    "%s was shorter than expected." %
+                        (getattr(f, "name", "File"), )
+                )
+
+            remaining -= len(chunk)
+            if remaining:
+                self._parts[0] = (f, remaining)
+            else:
+                self._parts.pop(0)
+
+            return chunk
+
+        return ""
+
+    def read(self, size = -1):
+        """
+        Reads up to ``size`` bytes of the body, or all of what's left if
+        ``size`` is negative.
+
+        """
+
+        pieces = [self._buffer]
+        have = len(self._buffer)
+        while size < 0 or have < size:
+            chunk = self._next_chunk()
+            if not chunk:
+                break
+
+            pieces.append(chunk)
+            have += len(chunk)
+
+        data = "".join(pieces)
+        if size >= 0:
+            data, self._buffer = data[:size], data[size:]
+        else:
+            self._buffer = ""
+
+        self.sent += len(data)
+        if self.progress is not None and data:
+            self.progress(self.sent, self.len)
+
+        return data
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+
+            yield chunk
+
+def _remaining_size(f):
+    """
+    Returns the number of bytes between the current position of a file and
+    its end.
+
+    """
+
+    try:
+        return os.fstat(f.fileno()).st_size - f.tell()
+    except (AttributeError, IOError, OSError):
+        # Not a real file, so find the end by seeking to it.
+        position = f.tell()
+        f.seek(0, os.SEEK_END)
+        size = f.tell() - position
+        f.seek(position)
+
+        return size
+
+def _to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+
+    return str(value)
+
+def _quote(value):
+    return _to_bytes(value).replace("\\", "\\\\").replace('"', '\\"')
@@ -0,0 +1,330 @@
+# Copyright (c) 2013 Galah Group LLC
+# Copyright (c) 2013 Other contributers as noted in the CONTRIBUTERS file
+#
+# This file is part of galah-apiclient.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This module handles pacing the API commands sent to a server, so that running
+many commands at once (such as in batch mode) doesn't overload it.
+
+Two limits are applied to each host, both off by default:
+
+* A token bucket limits how many commands are sent per second
+  (``rate-limit``), while allowing short bursts (``rate-burst``).
+* An adaptive limit on how many commands may be in progress at once. The limit
+  starts at ``max-concurrency`` and is halved whenever the server is
+  struggling, which is when it responds with a 5xx status or an error it
+  didn't explain, or when it takes more than ``latency-tolerance`` times as
+  long to respond as it usually does. While the server is keeping up, the
+  limit grows again by about one for every limit's worth of commands
+  (additive increase, multiplicative decrease, like TCP).
+
+Any of these options can be set for a single host in the ``host-limits``
+option of the configuration file:
+
+.. code-block:: yaml
+
+    rate-limit: 10
+    host-limits:
+        https://small.galah.edu:
+            rate-limit: 2
+            max-concurrency: 2
+
+"""
+
+import time
+import threading
+
+import config
+import pretty
+
+import logging
+logger = logging.getLogger("apiclient.ratelimit")
+
+#: The factor the concurrency limit is multiplied by when the server is
+#: struggling.
+DECREASE_FACTOR = 0.5
+
+#: How quickly the usual response time adapts to a new value. The usual
+#: response time follows the fastest recent responses, quickly adapting to
+#: faster ones and slowly to slower ones.
+BASELINE_RISE = 0.01
+
+#: A response is only considered slow if it also took at least this many
+#: seconds longer than usual, so the jitter of very fast responses is ignored.
+LATENCY_SLACK = 0.05
+
+class TokenBucket(object):
+    """
+    Allows ``rate`` events per second on average, and up to ``burst`` at
+    once.
+
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until an event is allowed.
+
+        :returns: The number of seconds spent waiting.
+
+        """
+
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+
+                delay = (1 - self.tokens) / self.rate
+
+            time.sleep(delay)
+            waited += delay
+
+class ConcurrencyLimit(object):
+    """
+    An adaptive limit on the number of commands in progress at once.
+
+    :ivar limit: The current limit. Fractional, only the whole part is used.
+    :ivar max_limit: The most the limit can grow to.
+    :ivar in_flight: The number of commands in progress.
+    :ivar baseline: The usual number of seconds the server takes to respond,
+            or ``None`` until it has responded.
+    :ivar decreases: The number of times the limit has been lowered.
+
+    """
+
+    def __init__(self, max_limit, latency_tolerance):
+        self.limit = float(max_limit)
+        self.max_limit = float(max_limit)
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.baseline = None
+        self.decreases = 0
+        self.lowest = self.limit
+
+        # Incremented whenever the limit is lowered, so a burst of failures
+        # caused by one overload only lowers it once.
+        self._epoch = 0
+
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """
+        Blocks until another command may be started.
+
+        :returns: A tuple ``(token, waited)``. ``token`` must be passed to
+                :meth:`release` when the command finishes, and ``waited`` is
+                the number of seconds spent waiting.
+
+        """
+
+        start = time.time()
+        with self._condition:
+            while self.in_flight >= max(1, int(self.limit)):
+                # Wait with a timeout so a KeyboardInterrupt can get through.
+                self._condition.wait(0.1)
+
+            self.in_flight += 1
+            return ((self._epoch, time.time()), time.time() - start)
+
+    def release(self, token, succeeded):
+        """
+        Records that a command finished and adjusts the limit.
+
+        :param succeeded: ``False`` if the server failed to handle the command.
+
+        """
+
+        epoch, started = token
+        latency = time.time() - started
+
+        with self._condition:
+            self.in_flight -= 1
+
+            slow = self.baseline is not None and \
+                latency > self.baseline * self.latency_tolerance and \
+                latency - self.baseline > LATENCY_SLACK
+
+            if succeeded:
+                if self.baseline is None or latency < self.baseline:
+                    self.baseline = latency
+                else:
+                    self.baseline += (latency - self.baseline) * BASELINE_RISE
+
+            if not succeeded or slow:
+                if epoch == self._epoch:
+                    self._epoch += 1
+                    self.decreases += 1
+                    self.limit = max(1.0, self.limit * DECREASE_FACTOR)
+                    self.lowest = min(self.lowest, self.limit)
+                    logger.debug(
+                        "Lowered concurrency limit to %d.", int(self.limit)
+                    )
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+            self._condition.notify_all()
+
+class HostLimiter(object):
+    """
+    Applies the configured limits to the commands sent to one host, and keeps
+    statistics about them.
+
+    :ivar bucket: A :class:`TokenBucket`, or ``None`` if the rate isn't
+            limited.
+    :ivar concurrency: A :class:`ConcurrencyLimit`, or ``None`` if the number
+            of commands in progress isn't limited.
+
+    """
+
+    def __init__(self, host, rate = 0, burst = 1, max_concurrency = 0,
+            latency_tolerance = 2.0):
+        self.host = host
+
+        self.bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self.concurrency = None
+        if max_concurrency > 0:
+            self.concurrency = \
+                ConcurrencyLimit(max_concurrency, latency_tolerance)
+
+        self.requests = 0
+        self.failures = 0
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.bucket is not None or self.concurrency is not None
+
+    def acquire(self):
+        """
+        Blocks until a command may be sent.
+
+        :returns: A token to pass to :meth:`release`.
+
+        """
+
+        waited = 0.0
+        if self.bucket is not None:
+            waited = self.bucket.acquire()
+
+        # Taken after the token bucket, so time spent waiting on the rate
+        # limit isn't mistaken for the server being slow.
+        token = None
+        if self.concurrency is not None:
+            token, concurrency_waited = self.concurrency.acquire()
+            waited += concurrency_waited
+
+        with self.lock:
+            self.requests += 1
+            self.waited += waited
+
+        return token
+
+    def release(self, token, response):
+        """
+        Records that a command finished.
+
+        :param response: The ``requests.Response`` the server sent, or
+                ``None`` if it didn't respond.
+
+        """
+
+        succeeded = response is not None and response.status_code < 500
+        if succeeded and response.headers.get("X-CallSuccess") == "False":
+            # The server explains errors that are our fault.
+            succeeded = "X-ErrorType" in response.headers
+
+        if not succeeded:
+            with self.lock:
+                self.failures += 1
+
+        if self.concurrency is not None:
+            self.concurrency.release(token, succeeded)
+
+    def summary(self):
+        """
+        Returns a one-line description of how the limits have affected the
+        commands sent so far.
+
+        """
+
+        with self.lock:
+            result = "%s: %d sent, %d failed, %.1fs waited in total" % (
+                self.host, self.requests, self.failures, self.waited
+            )
+
+        if self.concurrency is not None:
+            result += ", concurrency limit %d (lowest %d, lowered %d %s)" % (
+                int(self.concurrency.limit), int(self.concurrency.lowest),
+                self.concurrency.decreases,
+                pretty.plural_if("time", self.concurrency.decreases)
+            )
+
+        return result
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def _host_setting(host, name):
+    host_limits = config.CONFIG.get("host-limits")
+    if isinstance(host_limits, dict) and \
+            name in (host_limits.get(host) or {}):
+        return host_limits[host][name]
+
+    return config.CONFIG[name]
+
+def for_host(host):
+    """
+    Returns the :class:`HostLimiter` for a host, creating it from the
+    configuration the first time.
+
+    """
+
+    with _limiters_lock:
+        if host not in _limiters:
+            _limiters[host] = HostLimiter(
+                host,
+                rate = float(_host_setting(host, "rate-limit")),
+                burst = int(_host_setting(host, "rate-burst")),
+                max_concurrency = int(_host_setting(host, "max-concurrency")),
+                latency_tolerance =
+                    float(_host_setting(host, "latency-tolerance"))
+            )
+
+        return _limiters[host]
+
+def limiters():
+    """
+    Returns every :class:`HostLimiter` that has been created.
+
+    """
+
+    with _limiters_lock:
+        return list(_limiters.values())
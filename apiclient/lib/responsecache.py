@@ -0,0 +1,265 @@
+# Copyright (c) 2013 Galah Group LLC
+# Copyright (c) 2013 Other contributers as noted in the CONTRIBUTERS file
+#
+# This file is part of galah-apiclient.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This module handles caching the responses to read-only commands, so running
+the same command again soon after doesn't need to ask the server.
+
+Only commands listed in the ``cache-commands`` option are cached. Each
+response is stored in its own file in the ``cache-path`` directory, named
+after a hash of the server, the user and the command with all of its
+arguments. A file starts with a line of JSON describing the response,
+followed by the body exactly as the server sent it.
+
+Files are written to a temporary file and renamed into place, so any number of
+processes can share the cache. A file's modification time is updated whenever
+it is used, and when the cache grows past ``cache-max-size`` the least
+recently used files are removed.
+
+Every :class:`ResponseCache` also keeps the most recently used responses in
+memory, which helps the shell and batch modes where one session runs many
+commands.
+
+"""
+
+import os
+import sys
+import time
+import errno
+import hashlib
+import tempfile
+import threading
+import collections
+
+import utils
+import config
+
+import logging
+logger = logging.getLogger("apiclient.responsecache")
+
+#: The number of responses each :class:`ResponseCache` keeps in memory.
+MEMORY_ENTRIES = 256
+
+#: Responses are written to files starting with this before being renamed.
+TEMP_PREFIX = ".tmp"
+
+#: Temporary files older than this many seconds were left behind by a process
+#: that died, and can be removed.
+TEMP_MAX_AGE = 60 * 60
+
+def from_config():
+    """
+    Creates a :class:`ResponseCache` as described by the configuration.
+
+    :returns: The cache, or ``None`` if caching is turned off.
+
+    """
+
+    commands = config.command_set("cache-commands")
+    if not commands or config.CONFIG.get("no-cache"):
+        return None
+
+    return ResponseCache(
+        config.CONFIG["cache-path"], commands, config.CONFIG["cache-ttl"],
+        config.CONFIG["cache-max-size"]
+    )
+
+class ResponseCache(object):
+    """
+    A cache of responses to commands, stored on disk and in memory.
+
+    :ivar path: The directory the cache is stored in.
+    :ivar commands: The names of the commands that may be cached.
+    :ivar ttl: The number of seconds a response can be used for.
+    :ivar max_size: The most bytes the files in the cache may take up.
+
+    """
+
+    def __init__(self, path, commands, ttl, max_size):
+        self.path = path
+        self.commands = commands
+        self.ttl = ttl
+        self.max_size = max_size
+
+        self._memory = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(host, user, command, request):
+        """
+        Returns the key a response is stored under.
+
+        :param request: The command's arguments, as given by
+                :meth:`function.Function.resolve_arguments`.
+
+        """
+
+        return hashlib.sha1(utils.to_json(
+            [host, user, command, sorted(request.items())]
+        )).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key):
+        """
+        Looks up a response that hasn't expired.
+
+        :returns: A tuple ``(encoding, body)``, or ``None`` if there is no
+                such response.
+
+        """
+
+        now = time.time()
+
+        with self._lock:
+            entry = self._memory.pop(key, None)
+            if entry is not None and now - entry[0] <= self.ttl:
+                self._memory[key] = entry
+                return entry[1:]
+
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path, "rb") as f:
+                header = utils.json_module().loads(f.readline())
+                if now - header["created"] > self.ttl:
+                    return None
+
+                encoding = header["encoding"]
+                if encoding is not None:
+                    encoding = str(encoding)
+
+                body = f.read()
+
+            # Mark the file as recently used.
+            os.utime(entry_path, None)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                logger.debug(
+                    "Could not read cached response at %s.", entry_path,
+                    exc_info = True
+                )
+            return None
+        except (ValueError, KeyError, TypeError):
+            logger.debug(
+                "Cached response at %s is corrupt.", entry_path,
+                exc_info = True
+            )
+            return None
+
+        self._remember(key, header["created"], encoding, body)
+
+        return (encoding, body)
+
+    def put(self, key, encoding, body):
+        """
+        Stores a response, then removes old responses if the cache has grown
+        too large.
+
+        """
+
+        created = time.time()
+        self._remember(key, created, encoding, body)
+
+        try:
+            utils.prepare_directory(self.path)
+
+            fd, temp_path = tempfile.mkstemp(
+                dir = self.path, prefix = TEMP_PREFIX
+            )
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(utils.to_json({
+                        "created": created,
+                        "encoding": encoding
+                    }) + "\n")
+                    f.write(body)
+
+                os.rename(temp_path, self._entry_path(key))
+            except:
+                os.remove(temp_path)
+                raise
+        except (IOError, OSError):
+            logger.warn(
+                "Could not save response to cache at %s.", self.path,
+                exc_info = sys.exc_info()
+            )
+            return
+
+        self.evict()
+
+    def _remember(self, key, created, encoding, body):
+        with self._lock:
+            self._memory.pop(key, None)
+            self._memory[key] = (created, encoding, body)
+            while len(self._memory) > MEMORY_ENTRIES:
+                self._memory.popitem(last = False)
+
+    def evict(self):
+        """
+        Removes the least recently used responses until the cache is no
+        larger than :attr:`max_size`.
+
+        Other processes may be adding and removing responses at the same
+        time, so any response that disappears while we look at it is skipped.
+
+        """
+
+        entries = []
+        total = 0
+        now = time.time()
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            logger.debug("Could not list %s.", self.path, exc_info = True)
+            return
+
+        for i in names:
+            entry_path = os.path.join(self.path, i)
+            try:
+                stat = os.stat(entry_path)
+            except OSError:
+                continue
+
+            # Leave responses other processes are still writing alone, but
+            # clean up after any that died part way through.
+            if i.startswith(TEMP_PREFIX) and \
+                    now - stat.st_mtime < TEMP_MAX_AGE:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+            total += stat.st_size
+
+        if total <= self.max_size:
+            return
+
+        entries.sort()
+        for _, size, entry_path in entries:
+            if total <= self.max_size:
+                break
+
+            try:
+                os.remove(entry_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    logger.debug(
+                        "Could not remove cached response at %s.", entry_path,
+                        exc_info = True
+                    )
+                    continue
+
+            total -= size
@@ -0,0 +1,275 @@
+# Copyright (c) 2013 Galah Group LLC
+# Copyright (c) 2013 Other contributers as noted in the CONTRIBUTERS file
+#
+# This file is part of galah-apiclient.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This module handles retrying requests that failed for reasons that are likely
+to go away on their own, such as a dropped connection or a server that is
+restarting.
+
+How eagerly a request is retried depends on whether it is idempotent, meaning
+that sending it twice has the same effect as sending it once:
+
+* Idempotent requests (logging in, fetching the API info or a download, and
+  any command listed in the ``idempotent-commands`` option) are retried after
+  a connection error, a timeout, or a 502, 503 or 504 response.
+* Any other command is only retried when we know the server never started
+  on it: when the connection couldn't be made in the first place, or when
+  the server responded with 503 Service Unavailable.
+
+Between attempts we back off exponentially with random jitter (see
+:func:`utils.backoff_delays`), or wait as long as a ``Retry-After`` header
+says to. No more than ``retry-attempts`` attempts are made, and no retry is
+started once ``retry-deadline`` seconds have passed since the first attempt.
+
+"""
+
+import time
+import errno
+import socket
+import threading
+
+import utils
+import config
+import timings
+
+import logging
+logger = logging.getLogger("apiclient.retry")
+
+requests = utils.requests_module()
+
+#: The statuses an idempotent request is retried after.
+RETRY_STATUSES = frozenset([502, 503, 504])
+
+#: The statuses any request is retried after. The server promises it didn't
+#: act on the request when it sends these.
+UNPROCESSED_STATUSES = frozenset([503])
+
+class RetryStats(object):
+    """
+    Counts how often requests have been retried, for anyone who wants to
+    know. Shared by every :class:`RetryPolicy`.
+
+    :ivar requests: The number of requests made through a policy.
+    :ivar retried: The number of requests that were retried at least once.
+    :ivar retries: The number of times a request was sent again.
+    :ivar failures: The number of requests that still failed after being
+            retried as much as allowed.
+    :ivar reasons: A dictionary mapping each reason a request was retried
+            (such as ``"503"`` or ``"ConnectionError"``) to how many times it
+            happened.
+
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.retried = 0
+        self.retries = 0
+        self.failures = 0
+        self.reasons = {}
+        self.lock = threading.Lock()
+
+    def record_retry(self, reason, first):
+        with self.lock:
+            if first:
+                self.retried += 1
+            self.retries += 1
+            self.reasons[reason] = self.reasons.get(reason, 0) + 1
+
+    def summary(self):
+        """
+        Returns a one-line description of the retries so far.
+
+        """
+
+        with self.lock:
+            return "%d of %d requests retried %d times (%s), %d gave up" % (
+                self.retried, self.requests, self.retries,
+                ", ".join(
+                    "%s: %d" % i for i in sorted(self.reasons.items())
+                ),
+                self.failures
+            )
+
+#: The statistics for every retry in this process.
+stats = RetryStats()
+
+def never_sent(error):
+    """
+    Returns ``True`` iff a connection error means the request couldn't have
+    reached the server, because no connection was made.
+
+    """
+
+    connect_timeout = getattr(requests.exceptions, "ConnectTimeout", None)
+    if connect_timeout is not None and isinstance(error, connect_timeout):
+        return True
+
+    # Dig down through the exceptions requests and urllib3 wrap the socket's
+    # exception in.
+    cause = error
+    for _ in xrange(5):
+        if type(cause).__name__ in ("NewConnectionError",
+                "ConnectTimeoutError"):
+            return True
+        elif isinstance(cause, socket.error) and \
+                cause.errno in (errno.ECONNREFUSED, errno.EHOSTUNREACH,
+                    errno.ENETUNREACH):
+            return True
+
+        cause = getattr(cause, "reason", None) or \
+            (getattr(cause, "args", None) or [None])[0]
+        if not isinstance(cause, BaseException):
+            break
+
+    return False
+
+class RetryPolicy(object):
+    """
+    Decides whether and when a failed request is sent again.
+
+    :ivar max_attempts: The most times a request is sent.
+    :ivar initial_delay: The interval the first delay is chosen from, in
+            seconds.
+    :ivar max_delay: The largest interval a delay is chosen from.
+    :ivar deadline: The number of seconds after the first attempt that no
+            more attempts are started. ``0`` for no deadline.
+
+    """
+
+    def __init__(self, max_attempts = 4, initial_delay = 0.5,
+            max_delay = 8.0, deadline = 60.0):
+        self.max_attempts = max(1, max_attempts)
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            max_attempts = config.CONFIG["retry-attempts"],
+            initial_delay = config.CONFIG["retry-initial-delay"],
+            max_delay = config.CONFIG["retry-max-delay"],
+            deadline = config.CONFIG["retry-deadline"]
+        )
+
+    def retry_reason(self, idempotent, response = None, error = None):
+        """
+        Returns why a request should be retried after it got ``response`` or
+        raised ``error``, or ``None`` if it shouldn't be.
+
+        """
+
+        if error is not None:
+            if isinstance(error, requests.exceptions.SSLError):
+                # Trying again won't fix a certificate.
+                return None
+            elif not isinstance(error, (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout)):
+                return None
+            elif idempotent or never_sent(error):
+                return type(error).__name__
+            else:
+                return None
+
+        statuses = RETRY_STATUSES if idempotent else UNPROCESSED_STATUSES
+        if response.status_code in statuses:
+            return str(response.status_code)
+
+        return None
+
+    def call(self, send, idempotent, description):
+        """
+        Calls ``send`` until it succeeds, or until we run out of attempts or
+        time.
+
+        :param send: A function that makes the request and returns a
+                ``requests.Response``. It is called once per attempt, so it
+                must be safe to call again (any files being uploaded must be
+                rewound, for example).
+        :param idempotent: Whether the request may safely be sent more than
+                once.
+        :param description: Describes the request in log messages, such as
+                ``"logging in"``.
+        :returns: The last response received. If it is one we would have
+                retried, we ran out of attempts.
+        :raises: The exception ``send`` raised on the last attempt, if it
+                raised one.
+
+        """
+
+        with stats.lock:
+            stats.requests += 1
+
+        delays = utils.backoff_delays(
+            min(self.initial_delay, self.max_delay), self.max_delay
+        )
+        started = time.time()
+        attempt = 1
+        while True:
+            response = None
+            try:
+                response = send()
+            except requests.exceptions.RequestException as e:
+                reason = self.retry_reason(idempotent, error = e)
+                if reason is None:
+                    raise
+                last_error = e
+            else:
+                reason = self.retry_reason(idempotent, response = response)
+                if reason is None:
+                    return response
+
+            delay = next(delays)
+            if response is not None:
+                retry_after = utils.parse_retry_after(
+                    response.headers.get("Retry-After")
+                )
+                if retry_after is not None:
+                    delay = retry_after
+
+            elapsed = time.time() - started
+            out_of_time = self.deadline and \
+                elapsed + delay > self.deadline
+            if attempt >= self.max_attempts or out_of_time:
+                with stats.lock:
+                    stats.failures += 1
+
+                if attempt > 1:
+                    logger.warn(
+                        "Giving up on %s after %d attempts over %.1f "
+                        "seconds.", description, attempt, elapsed
+                    )
+
+                if response is None:
+                    raise last_error
+
+                return response
+
+            logger.info(
+                "Retrying %s in %.1f seconds after %s (attempt %d of %d).",
+                description, delay, reason, attempt + 1, self.max_attempts
+            )
+            stats.record_retry(reason, attempt == 1)
+
+            if response is not None:
+                # Read the (small) body so the connection is returned to the
+                # pool for the next attempt.
+                response.content
+
+            with timings.phase("retry-wait"):
+                time.sleep(delay)
+            attempt += 1
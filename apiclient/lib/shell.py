@@ -23,6 +23,8 @@ This module handles creating and defining the shell interface.
 import cmd
 import shlex
 import ui
+import batch
+import config
 
 class APIShell(cmd.Cmd):
 	intro = "Welcome to the Galah API Client shell."
@@ -31,6 +33,12 @@ class APIShell(cmd.Cmd):
 	def __init__(self, session, *args, **kwargs):
 		self.session = session
 
+		# Background jobs by job number, see start_job().
+		self.jobs = {}
+		self._job_results = {}
+		self._next_job = 1
+		self._pool = None
+
 		cmd.Cmd.__init__(self, *args, **kwargs)
 
 	def default(self, raw_args):
@@ -38,12 +46,23 @@ class APIShell(cmd.Cmd):
 		This is called whenever a command is entered that the `cmd` library
 		doesn't recognize, which should be all API commands.
 
+		Commands ending in ``&`` are run in the background.
+
 		"""
 
+		background = raw_args.rstrip().endswith("&")
+		if background:
+			raw_args = raw_args.rstrip()[:-1]
+
 		# Split up what the user typed in, just like how bash does it.
 		args = shlex.split(raw_args)
 		if not args:
 			return
+
+		if background:
+			self.start_job(raw_args.strip(), args)
+			return
+
 		command = args.pop(0)
 
 		# Perform the command the user wants to execute
@@ -56,6 +75,176 @@ class APIShell(cmd.Cmd):
 		except KeyboardInterrupt:
 			print "Interrupted..."
 
+	def start_job(self, raw, args):
+		"""
+		Runs a command in the background. Its output is captured and shown
+		once it finishes.
+
+		"""
+
+		import multiprocessing.pool
+
+		if self._pool is None:
+			self._pool = multiprocessing.pool.ThreadPool(
+				max(1, config.CONFIG["jobs"])
+			)
+
+		job = batch.BatchCommand(str(self._next_job), raw, args)
+		self._next_job += 1
+
+		self.jobs[job.label] = job
+		self._job_results[job.label] = self._pool.apply_async(
+			batch.run_command, (self.session, job)
+		)
+
+		print "[%s] %s" % (job.label, raw)
+
+	def wait_job(self, label):
+		"""
+		Blocks until a background job has finished and returns it.
+
+		"""
+
+		result = self._job_results[label]
+
+		# Wait with a timeout so a KeyboardInterrupt can get through.
+		while not result.ready():
+			result.wait(0.1)
+
+		return self.jobs[label]
+
+	def _show_job(self, job):
+		print "[%s] %s (exit status %d) %s" % (
+			job.label, "Done" if job.succeeded else "Failed",
+			job.exit_status, job.raw
+		)
+		if job.output:
+			print job.output.rstrip("\n")
+
+		del self.jobs[job.label]
+		del self._job_results[job.label]
+
+	def _finished_jobs(self):
+		return [
+			self.jobs[i] for i in sorted(self.jobs, key = int)
+				if self._job_results[i].ready()
+		]
+
+	def postcmd(self, stop, line):
+		"""
+		Called after every command. Shows the output of any background
+		jobs and downloads that have finished since the last command.
+
+		"""
+
+		for i in self._finished_jobs():
+			self._show_job(i)
+
+		manager = self.session.download_manager
+		if manager is not None:
+			for i in manager.pop_finished():
+				print "Finished %s:" % (i, )
+				print i.output.rstrip("\n")
+
+		return stop
+
+	def postloop(self):
+		"""
+		Called when the shell is exiting. Waits for any background jobs and
+		downloads to finish.
+
+		"""
+
+		if self.jobs:
+			print "Waiting for jobs to finish..."
+			self.do_wait("")
+
+		manager = self.session.download_manager
+		if manager is not None and manager.pending():
+			print "Waiting for downloads to finish..."
+			manager.wait()
+			self.postcmd(False, "")
+
+	def do_downloads(self, arg):
+		"""
+		Shows the progress of any background downloads.
+
+		"""
+
+		manager = self.session.download_manager
+		if manager is None or not manager.downloads:
+			print "No downloads."
+			return
+
+		print manager.progress()
+		for i in manager.pending():
+			print "    %s" % (i, )
+
+	def do_jobs(self, arg):
+		"""
+		Lists the commands running in the background.
+
+		"""
+
+		if not self.jobs:
+			print "No jobs."
+			return
+
+		for i in sorted(self.jobs, key = int):
+			print "[%s] %s %s" % (
+				i, "Done" if self._job_results[i].ready() else "Running",
+				self.jobs[i].raw
+			)
+
+	def _parse_job(self, arg):
+		"""
+		Returns the job number given to a builtin, or the most recently
+		started job if none was given. Returns ``None`` if there is no such
+		job.
+
+		"""
+
+		label = arg.strip().lstrip("%")
+		if not label:
+			return max(self.jobs, key = int) if self.jobs else None
+
+		return label if label in self.jobs else None
+
+	def do_wait(self, arg):
+		"""
+		Waits for the given background job, or every job if none is given,
+		to finish, showing each one's output as it does.
+
+		"""
+
+		if arg.strip():
+			label = self._parse_job(arg)
+			if label is None:
+				print "No such job", arg.strip()
+				return
+
+			labels = [label]
+		else:
+			labels = sorted(self.jobs, key = int)
+
+		for i in labels:
+			self._show_job(self.wait_job(i))
+
+	def do_fg(self, arg):
+		"""
+		Waits for a background job, the most recent one if none is given,
+		and shows its output.
+
+		"""
+
+		label = self._parse_job(arg)
+		if label is None:
+			print "No such job" + (" " + arg.strip() if arg.strip() else ".")
+			return
+
+		print self.jobs[label].raw
+		self._show_job(self.wait_job(label))
+
 	def do_help(self, arg):
 		if arg:
 			func = self.session.api_info.get(arg)
@@ -0,0 +1,293 @@
+# Copyright (c) 2013 Galah Group LLC
+# Copyright (c) 2013 Other contributers as noted in the CONTRIBUTERS file
+#
+# This file is part of galah-apiclient.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+#
+# You may obtain a copy of the License at
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This module handles measuring where the time goes when the API client runs
+(see the ``--timings`` and ``--timings-file`` options).
+
+Time is measured separately for starting up (loading the configuration, the
+session and the API info, and logging in) and for each command executed. Each
+of these records is split into phases:
+
+* ``config``: loading the configuration.
+* ``setup``: importing ``requests`` and the rest of the modules that talk to
+  the server, and creating the session.
+* ``load``: loading the session and the API info from disk.
+* ``login``: logging in, including waiting on the server.
+* ``dns``, ``connect`` and ``tls``: looking up the server's address, opening
+  a connection to it and the TLS handshake. Connections are reused, so these
+  only appear when a new connection was needed.
+* ``rate-limit``: waiting for the rate limits (see :mod:`ratelimit`).
+* ``server``: sending a command and waiting for the server to respond to it.
+* ``retry-wait``: waiting before retrying a request (see :mod:`retry`).
+* ``response``: receiving and printing a text response.
+* ``download-poll``: waiting for the server to get a download ready.
+* ``download``: receiving a download.
+* ``agent``: waiting on the agent to execute the command (see :mod:`agent`).
+
+Phases don't overlap: time spent in a phase while in another (such as opening
+a connection while logging in) only counts towards the innermost one. Any time
+not spent in a phase is reported as ``other``.
+
+With ``--timings`` a breakdown of each record is printed to standard error as
+soon as it is finished. With ``--timings-file`` each record is appended to the
+given file as a line of JSON, such as:
+
+.. code-block:: javascript
+
+    {"label": "find_user", "pid": 2411, "started": 1381795224.53,
+     "total": 0.186, "phases": {"dns": 0.0004, "connect": 0.0003,
+     "server": 0.181, "response": 0.0012, "other": 0.0031}}
+
+"""
+
+import os
+import sys
+import time
+import threading
+import contextlib
+import collections
+
+import utils
+
+import logging
+logger = logging.getLogger("apiclient.timings")
+
+_local = threading.local()
+
+_output_lock = threading.Lock()
+
+#: Whether a breakdown is printed as each record finishes.
+_print_breakdown = False
+
+#: The file records are appended to, or ``None``.
+_file_path = None
+
+class Record(object):
+    """
+    The time spent in each phase of starting up or of executing a command.
+
+    :ivar label: What the record is of, such as ``"startup"`` or the name of
+            the command.
+    :ivar started: When the record was started, as a UNIX timestamp.
+    :ivar total: The number of seconds between starting and finishing the
+            record, or ``None`` if it isn't finished.
+    :ivar phases: An ordered dictionary mapping the name of each phase to the
+            number of seconds spent in it, in the order the phases were first
+            entered.
+
+    """
+
+    def __init__(self, label):
+        self.label = label
+        self.started = time.time()
+        self.total = None
+        self.phases = collections.OrderedDict()
+
+        # The time spent in phases nested within each phase currently
+        # entered, innermost last.
+        self._nested = []
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def finish(self):
+        self.total = time.time() - self.started
+
+        other = self.total - sum(self.phases.values())
+        if other > 0:
+            self.phases["other"] = other
+
+    def to_dict(self):
+        return {
+            "label": self.label,
+            "pid": os.getpid(),
+            "started": self.started,
+            "total": self.total,
+            "phases": self.phases
+        }
+
+    def __str__(self):
+        return "Timings for %s: %s total (%s)" % (
+            self.label, _format_duration(self.total),
+            ", ".join(
+                "%s %s" % (k, _format_duration(v))
+                    for k, v in self.phases.items()
+            )
+        )
+
+def _format_duration(seconds):
+    if seconds < 1:
+        return "%.1fms" % (seconds * 1000, )
+
+    return "%.2fs" % (seconds, )
+
+def enable(print_breakdown = False, file_path = None):
+    """
+    Starts reporting records as they finish, and starts measuring the time
+    spent making connections.
+
+    :param print_breakdown: If ``True``, a breakdown of each record is
+            printed to standard error.
+    :param file_path: If not ``None``, each record is appended to this file as
+            a line of JSON.
+
+    """
+
+    global _print_breakdown, _file_path
+
+    _print_breakdown = print_breakdown
+    _file_path = None if file_path is None else utils.resolve_path(file_path)
+
+    _instrument_connections()
+
+def current():
+    """
+    Returns the :class:`Record` being kept by this thread, or ``None``.
+
+    """
+
+    return getattr(_local, "record", None)
+
+def begin(label):
+    """
+    Starts keeping a record in this thread, unless one is already being kept.
+
+    :returns: ``True`` if a new record was started. Only then should
+            :func:`end` be called.
+
+    """
+
+    if current() is not None:
+        return False
+
+    _local.record = Record(label)
+    return True
+
+def end():
+    """
+    Finishes the record being kept by this thread and reports it.
+
+    """
+
+    record = current()
+    _local.record = None
+
+    record.finish()
+    _report(record)
+
+@contextlib.contextmanager
+def record(label):
+    """
+    Keeps a record of the enclosed code, unless this thread is already
+    keeping one (in which case the time counts towards that record).
+
+    """
+
+    started = begin(label)
+    try:
+        yield
+    finally:
+        if started:
+            end()
+
+@contextlib.contextmanager
+def phase(name):
+    """
+    Counts the time spent in the enclosed code, less the time spent in any
+    phases nested within it, towards the phase ``name`` of this thread's
+    record. Does nothing if this thread isn't keeping a record.
+
+    """
+
+    record = current()
+    if record is None:
+        yield
+        return
+
+    record._nested.append(0.0)
+    started = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - started
+        record.add(name, elapsed - record._nested.pop())
+        if record._nested:
+            record._nested[-1] += elapsed
+
+def _report(record):
+    global _file_path
+
+    if not _print_breakdown and _file_path is None:
+        return
+
+    with _output_lock:
+        if _print_breakdown:
+            print >> sys.stderr, str(record)
+
+        if _file_path is not None:
+            try:
+                with open(_file_path, "a") as f:
+                    f.write(utils.to_json(record.to_dict()) + "\n")
+            except IOError:
+                logger.warn(
+                    "Could not write timings to %s.", _file_path,
+                    exc_info = sys.exc_info()
+                )
+
+                # Don't complain again for every command.
+                _file_path = None
+
+def timed(name):
+    """
+    A decorator that counts the time spent in a function towards the phase
+    ``name``. See :func:`phase`.
+
+    """
+
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper._timings_original = func
+        return wrapper
+
+    return decorator
+
+def _instrument_connections():
+    """
+    Wraps the functions ``requests`` uses to open connections so the time
+    spent in them is measured. Python 2's ``socket`` module doesn't offer any
+    hooks, so this is the only way to see inside a request.
+
+    """
+
+    import socket
+    import ssl
+
+    targets = [
+        (socket, "getaddrinfo", "dns"),
+        (socket.socket, "connect", "connect"),
+        (ssl.SSLSocket, "do_handshake", "tls")
+    ]
+    for owner, attribute, name in targets:
+        func = getattr(owner, attribute)
+        if not hasattr(func, "_timings_original"):
+            setattr(owner, attribute, timed(name)(func))
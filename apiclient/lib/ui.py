@@ -79,18 +79,22 @@ def parse_raw_args(args):
 
     return (positional_arguments, keyword_arguments)
 
-def determine_credentials():
+def determine_credentials(user = None):
     """
     Determines the username and password the user wants to log in with.
 
     This is done by checking the configuration and environmental variables for
     the needed values, and prompting the user when they are unavailable.
 
+    :param user: The user to log in as. If ``None``, the user is determined
+            like the password is.
     :returns: ``(user, password)``
 
     """
 
-    if "user" in config.CONFIG:
+    if user is not None:
+        pass
+    elif "user" in config.CONFIG:
         user = config.CONFIG["user"]
     else:
         user = raw_input("What user would you like to log in as?: ")
@@ -109,14 +113,120 @@ def determine_credentials():
 
     return (user, password)
 
+import threading
+import contextlib
+_output = threading.local()
+def output():
+    """
+    Returns the stream that command output should be written to from the
+    current thread. This is standard out unless :func:`redirect_output` is in
+    effect.
+
+    """
+
+    return getattr(_output, "stream", None) or sys.stdout
+
+def is_redirected():
+    """
+    Returns ``True`` iff output from the current thread is being redirected
+    somewhere other than standard out.
+
+    """
+
+    return getattr(_output, "stream", None) is not None
+
+@contextlib.contextmanager
+def redirect_output(stream):
+    """
+    A context manager that sends any command output produced by the current
+    thread to ``stream`` rather than standard out. Other threads are not
+    affected.
+
+    .. code-block:: python
+
+        buf = StringIO.StringIO()
+        with ui.redirect_output(buf):
+            session.call("find_user", "jsull")
+
+    """
+
+    old_stream = getattr(_output, "stream", None)
+    _output.stream = stream
+    try:
+        yield stream
+    finally:
+        _output.stream = old_stream
+
+def run_redirected(func, out, log = None):
+    """
+    Calls ``func`` with no arguments, sending anything it prints from the
+    current thread to ``out`` and anything it logs to ``log`` (or ``out`` if
+    ``log`` is ``None``).
+
+    Functions in this client signal failure by calling ``sys.exit()``, so a
+    ``SystemExit`` is treated as the function's exit status rather than
+    allowed to propagate.
+
+    :returns: A tuple ``(exit_status, return_value)``. ``exit_status`` is
+            ``0`` iff ``func`` succeeded, and ``return_value`` is ``None`` if
+            it did not.
+
+    """
+
+    import logcontrol
+
+    return_value = None
+    with redirect_output(out), logcontrol.redirect(out if log is None else log):
+        try:
+            return_value = func()
+            exit_status = 0
+        except SystemExit as e:
+            if e.code is None or e.code == 0:
+                exit_status = 0
+            elif isinstance(e.code, int):
+                exit_status = e.code
+            else:
+                exit_status = 1
+        except Exception:
+            logger.critical(
+                "Unexpected error while executing command.",
+                exc_info = sys.exc_info()
+            )
+            exit_status = 1
+
+    return (exit_status, return_value)
+
+def run_captured(func, *args, **kwargs):
+    """
+    Like :func:`run_redirected`, but captures the output in a string.
+
+    :returns: A tuple ``(exit_status, output, return_value)``.
+
+    """
+
+    import StringIO
+
+    buf = StringIO.StringIO()
+    exit_status, return_value = run_redirected(
+        lambda: func(*args, **kwargs), buf
+    )
+
+    return (exit_status, buf.getvalue(), return_value)
+
 import sys
 def print_carriage(text, width = 72):
     """
     Prints some text to standard out, followed by a carriage return. Also
     flushes standard out afterwards.
 
+    Nothing is printed if output is being redirected, as progress bars are only
+    meaningful on a terminal.
+
     """
 
+    if is_redirected():
+        return
+
     sys.stdout.write("\r" + str(text) + " " * (width - len(text)) + "\r")
     sys.stdout.flush()
 
@@ -189,3 +299,30 @@ def progress_bar(progress, size = 20):
         progress = min(progress, 1)
         done = int(round(size * progress))
         return "[" + "#" * done + " " * (size - done) + "]"
+
+def progress_printer(message, size = 20):
+    """
+    Creates a function suitable for reporting the progress of a transfer that
+    displays a progress bar followed by ``message``.
+
+    :param message: The text to display after the progress bar.
+    :param size: The width of the progress bar.
+    :returns: A function that should be called as ``progress(done, total)``.
+            The progress bar is only redrawn when it would actually change.
+
+    """
+
+    last = [None]
+    def progress(done, total):
+        if total:
+            percent = done * 100 // total
+            bar = progress_bar(done / float(total), size)
+        else:
+            percent = -1
+            bar = progress_bar(-1, size)
+
+        if percent != last[0]:
+            print_carriage(bar + " " + message)
+            last[0] = percent
+
+    return progress
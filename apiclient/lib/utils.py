@@ -146,7 +146,7 @@ def load_yaml(file):
     """
     Loads a YAML file safely.
 
-    :param file: A file object to load.
+    :param file: A file object or string to load.
     :returns: The deserialized contents of the file.
 
     """
@@ -155,6 +155,7 @@ def load_yaml(file):
 
 import os.path
 import os
+import errno
 def prepare_directory(path, permissions = 0o700):
     """
     Ensures a directory exists and creates it if necessary, including any
@@ -172,7 +173,15 @@ def prepare_directory(path, permissions = 0o700):
     if os.path.exists(path):
         return False
 
-    os.makedirs(path, permissions)
+    try:
+        os.makedirs(path, permissions)
+    except OSError as e:
+        # Someone else may have created it after we checked.
+        if e.errno == errno.EEXIST and os.path.isdir(path):
+            return False
+
+        raise
+
     return True
 
 HOME_DIR = os.path.expanduser("~")
@@ -271,3 +280,58 @@ def open_secure_file(path):
         )
 
         return None
+
+import random
+def backoff_delays(initial, maximum, factor = 2):
+    """
+    Generates an endless sequence of delays to use between attempts at
+    something, growing exponentially up to a maximum.
+
+    Each delay is chosen randomly from the upper half of the current interval
+    so that many clients backing off at once don't all retry at the same time.
+
+    :param initial: The interval for the first delay, in seconds.
+    :param maximum: The largest interval, in seconds.
+    :param factor: How much the interval grows by after each delay.
+
+    .. code-block:: text
+
+        >>> delays = utils.backoff_delays(1, 8)
+        >>> [round(next(delays), 2) for i in range(5)]
+        [0.83, 1.57, 3.41, 7.18, 4.62]
+
+    """
+
+    interval = float(initial)
+    while True:
+        yield random.uniform(interval / 2, interval)
+        interval = min(interval * factor, maximum)
+
+import time
+def parse_retry_after(value):
+    """
+    Parses the value of a ``Retry-After`` HTTP header.
+
+    :param value: The value of the header, which may be a number of seconds or
+            an HTTP date. May be ``None``.
+    :returns: The number of seconds to wait, or ``None`` if ``value`` could not
+            be parsed.
+
+    """
+
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    # Only needed for the uncommon case of a date, and slow to import.
+    import email.utils
+
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+
+    return max(0.0, email.utils.mktime_tz(parsed) - time.time())
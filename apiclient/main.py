@@ -18,7 +18,6 @@
 # limitations under the License.
 
 import sys
-import pprint
 import os
 
 def main():
@@ -28,17 +27,29 @@ def main():
     lib.logcontrol.init_logging()
     logger = logging.getLogger("apiclient")
 
+    # Time starting up, which is only reported if the user asks for it.
+    import lib.timings
+    lib.timings.begin("startup")
+
     # Load up the configuration, this includes parsing any command line
     # arguments.
     import lib.config as config
-    config.CONFIG = config.load_config()
+    with lib.timings.phase("config"):
+        config.CONFIG = config.load_config()
     if "verbosity" in config.CONFIG:
         lib.logcontrol.set_level(config.CONFIG["verbosity"])
-    logger.debug(
-        "Final configuration dictionary...\n%s",
-        pprint.pformat(config.CONFIG, width = 72)
-    )
+    if logger.isEnabledFor(logging.DEBUG):
+        import pprint
+        logger.debug(
+            "Final configuration dictionary...\n%s",
+            pprint.pformat(config.CONFIG, width = 72)
+        )
     lib.logcontrol.show_tracebacks = config.CONFIG["show-tracebacks"]
+    if config.CONFIG.get("timings") or config.CONFIG.get("timings-file"):
+        lib.timings.enable(
+            print_breakdown = config.CONFIG.get("timings"),
+            file_path = config.CONFIG.get("timings-file")
+        )
 
     # Set to True by any of the "do something and exit" options.
     exit_now = False
@@ -63,6 +74,11 @@ def main():
         if os.path.isfile(api_info_path):
             logger.info("Deleting session file at %s.", api_info_path)
             os.remove(api_info_path)
+
+            import lib.apicache
+            for i in (lib.apicache.SUFFIX, lib.apicache.META_SUFFIX):
+                if os.path.isfile(api_info_path + i):
+                    os.remove(api_info_path + i)
         else:
             logger.info(
                 "No session file exists at %s. Doing nothing.",
@@ -101,12 +117,48 @@ def main():
 
         exit_now = True
 
+    # If the user wants to stop the agent...
+    if config.CONFIG.get("stop-agent"):
+        import lib.agent
+
+        socket_path = config.CONFIG["agent-socket-path"]
+        if lib.agent.stop(socket_path):
+            logger.info("Stopped the agent at %s.", socket_path)
+        else:
+            logger.info(
+                "No agent is running at %s. Doing nothing.", socket_path
+            )
+
+        exit_now = True
+
     if exit_now:
         sys.exit(0)
 
+    # Let a running agent execute the command if there is one, it's much
+    # faster than logging in and loading everything ourselves.
+    modes = ("shell", "batch", "bulk", "agent", "no-agent")
+    if config.ARGS and not any(config.CONFIG.get(i) for i in modes) and \
+            os.path.exists(config.CONFIG["agent-socket-path"]):
+        import lib.agent
+        import lib.ui
+
+        command_args, command_kwargs = lib.ui.parse_raw_args(config.ARGS)
+        if command_args:
+            with lib.timings.phase("agent"):
+                exit_status = lib.agent.call(
+                    config.CONFIG["agent-socket-path"], command_args[0],
+                    command_args[1:], command_kwargs
+                )
+            if exit_status is not None:
+                # Starting up and the command are one and the same here.
+                lib.timings.current().label = command_args[0]
+                lib.timings.end()
+                sys.exit(exit_status)
+
     # Grab the user's old session information if they are already logged in.
-    import lib.communicate
-    session = lib.communicate.APIClientSession()
+    with lib.timings.phase("setup"):
+        import lib.communicate
+        session = lib.communicate.APIClientSession()
     session.load()
 
     save_session = False
@@ -120,20 +172,37 @@ def main():
             session.login(*lib.ui.determine_credentials())
 
         save_session = True
+    elif session.session_expired():
+        logger.info("Your session has expired. Logging in again.")
+        if config.CONFIG.get("use-oauth"):
+            session.login_oauth2()
+        else:
+            session.login(*lib.ui.determine_credentials(session.user))
+
+        save_session = True
 
     # Request the API info from the server if we don't have it cached
     if session.api_info is None:
         session.fetch_api_info()
         save_session = True
+    elif session.api_info_is_stale():
+        session.fetch_api_info(revalidate = True)
+        save_session = True
 
     # Save the session if we had to login or if we replenished our cache
     # (because they are tied together artificially by our design).
     if save_session:
         session.save()
 
+    lib.timings.end()
+
     # Enter the shell or execute a command.
     if config.CONFIG.get("shell"):
         import lib.shell
+        import lib.downloads
+        session.download_manager = lib.downloads.DownloadManager(
+            session, config.CONFIG["download-workers"]
+        )
         new_shell = lib.shell.APIShell(session)
 
         try:
@@ -148,6 +217,41 @@ def main():
                     break
 
         print "Exiting..."
+    elif config.CONFIG.get("batch"):
+        import lib.batch
+
+        batch_path = config.CONFIG["batch"]
+        try:
+            if batch_path == "-":
+                commands = lib.batch.read_commands(sys.stdin)
+            else:
+                with open(batch_path) as f:
+                    commands = lib.batch.read_commands(f)
+        except IOError:
+            logger.critical(
+                "Could not read batch file at %s.", batch_path,
+                exc_info = sys.exc_info()
+            )
+            sys.exit(1)
+
+        sys.exit(lib.batch.run_batch(
+            session, commands, config.CONFIG["jobs"],
+            config.CONFIG["download-workers"]
+        ))
+    elif config.CONFIG.get("agent"):
+        import lib.agent
+
+        lib.agent.Agent(session, config.CONFIG["agent-socket-path"]).serve()
+    elif config.CONFIG.get("bulk"):
+        import lib.bulk
+
+        sys.exit(lib.bulk.run_bulk(
+            session, config.CONFIG["bulk"], config.ARGS,
+            pattern = config.CONFIG["bulk-pattern"],
+            manifest_path = config.CONFIG.get("bulk-manifest"),
+            jobs = config.CONFIG["jobs"],
+            download_workers = config.CONFIG["download-workers"]
+        ))
     else:
         # Perform the command the user wants to execute
         command_args, command_kwargs = lib.ui.parse_raw_args(config.ARGS)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+"""
+Measures how long the API client takes to load its API info cache and look up
+a single command: the way it used to be done, from the JSON file, and from the
+compiled snapshot.
+
+A synthetic API info file with COMMANDS commands, each taking 8 parameters, is
+used.
+
+Usage: bench_api_info.py [COMMANDS]
+
+"""
+
+import os
+import sys
+import json
+import shutil
+import timeit
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "apiclient"))
+
+import lib.apicache as apicache
+import lib.communicate as communicate
+
+def main():
+    commands = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    api_info = [
+        {
+            "name": "command_%d" % (i, ),
+            "args": [
+                {
+                    "name": "arg_%d" % (j, ),
+                    "default_value": "value" if j > 4 else None,
+                    "takes_file": j == 7
+                } for j in xrange(8)
+            ]
+        } for i in xrange(commands)
+    ]
+    raw = json.dumps(api_info)
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        raw_path = os.path.join(temp_dir, "api-info")
+        with open(raw_path, "wb") as f:
+            f.write(raw)
+
+        # What used to be done: parse the JSON and build every function.
+        def before():
+            with open(raw_path, "rb") as f:
+                api_info = communicate._parse_api_info(json.loads(f.read()))
+            api_info.values()
+            return api_info["command_0"]
+
+        # Without a snapshot: parse the JSON, but build one function.
+        def uncompiled():
+            with open(raw_path, "rb") as f:
+                api_info = communicate._parse_api_info(json.loads(f.read()))
+            return api_info["command_0"]
+
+        apicache.save(
+            raw_path, raw, communicate._parse_api_info(api_info).compiled
+        )
+
+        def after():
+            return apicache.load(raw_path)["command_0"]
+
+        print "%d commands, %d bytes of API info" % (commands, len(raw))
+        for name, func in (("before", before), ("json", uncompiled),
+                ("after", after)):
+            seconds = min(timeit.repeat(func, number = 20, repeat = 3)) / 20
+            print "%-6s %8.2f ms per load" % (name, seconds * 1000)
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""
+Compares the API client's download throughput with curl's against a local
+stand-in server, which serves a file of the requested size from memory.
+
+Usage: bench_download.py [MEGABYTES]
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import SocketServer
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "apiclient"))
+
+import lib.config as config
+import lib.communicate as communicate
+import lib.ui as ui
+import lib.downloads as downloads
+
+BLOCK = os.urandom(1024 * 1024)
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(self.server.size))
+        self.end_headers()
+
+        remaining = self.server.size
+        while remaining > 0:
+            self.wfile.write(BLOCK[:remaining])
+            remaining -= len(BLOCK)
+
+    def log_message(self, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def timed(func):
+    start = time.time()
+    func()
+    return time.time() - start
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+
+    server = Server(("127.0.0.1", 0), Handler)
+    server.size = megabytes * 1024 * 1024
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:%d/archive.tar.gz" % (server.server_port, )
+
+    directory = tempfile.mkdtemp()
+    try:
+        config.CONFIG = dict(
+            (i.name, i.default_value)
+                for i in config.KNOWN_OPTIONS.values()
+                if i.default_value is not None
+        )
+        config.CONFIG["host"] = url
+        config.CONFIG["no-verify-certificate"] = True
+        session = communicate.APIClientSession()
+
+        devnull = open(os.devnull, "w")
+        def client():
+            r = session.requests_session.get(url, stream = True)
+            part = downloads.PartialDownload(
+                os.path.join(directory, "client"), url
+            )
+            with ui.redirect_output(devnull):
+                session._write_download(r, part)
+
+        def curl():
+            subprocess.check_call(
+                ["curl", "-s", "-o", os.path.join(directory, "curl"), url]
+            )
+
+        results = {}
+        for name, func in (("curl", curl), ("client", client)):
+            func() # Warm up the page cache and connection pool.
+            results[name] = min(timed(func) for _ in xrange(3))
+            print "%-6s %8.1f MB/s" % (name, megabytes / results[name])
+
+        print "client is at %.0f%% of curl's throughput." % (
+            results["curl"] / results["client"] * 100,
+        )
+    finally:
+        shutil.rmtree(directory)
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
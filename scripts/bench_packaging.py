@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""
+Compares how long packaged builds of the API client (such as the superzip
+built by ``superzip.sh`` and the archive built by ``build_zipapp.py``) take to
+start up.
+
+Each build is timed running the same command both cold, just after the
+operating system's file cache has been emptied, and warm, after it has already
+been run a few times. Emptying the file cache requires root. Without it the
+cold times are skipped.
+
+Builds are run with the Python running this script, rather than whatever
+their ``#!`` line points at, so they are all compared on the same footing.
+
+Usage::
+
+    bench_packaging.py [--runs N] BUILD... [-- COMMAND...]
+
+``COMMAND`` defaults to ``--logout`` with a session file that doesn't exist.
+
+"""
+
+import os
+import sys
+import time
+import tempfile
+import subprocess
+
+DROP_CACHES_PATH = "/proc/sys/vm/drop_caches"
+
+def drop_caches():
+    """
+    Empties the operating system's file cache.
+
+    :returns: ``True`` on success, ``False`` if it isn't allowed.
+
+    """
+
+    try:
+        subprocess.call(["sync"])
+        with open(DROP_CACHES_PATH, "w") as f:
+            f.write("3\n")
+    except (IOError, OSError):
+        return False
+
+    return True
+
+def run_build(build, args):
+    """
+    Runs a build of the API client and returns how long it took in
+    milliseconds. Exits if the build fails, as a build that crashes straight
+    away would otherwise look fast.
+
+    """
+
+    with open(os.devnull, "w") as devnull:
+        start = time.time()
+        status = subprocess.call(
+            [sys.executable, build] + args, stdout = devnull,
+            stderr = devnull
+        )
+        elapsed = (time.time() - start) * 1000
+
+    if status != 0:
+        print >> sys.stderr, "%s %s exited with status %d." % (
+            build, " ".join(args), status
+        )
+        sys.exit(1)
+
+    return elapsed
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def main():
+    args = sys.argv[1:]
+
+    command = None
+    if "--" in args:
+        command = args[args.index("--") + 1:]
+        args = args[:args.index("--")]
+
+    runs = 11
+    if "--runs" in args:
+        index = args.index("--runs")
+        runs = int(args[index + 1])
+        del args[index:index + 2]
+
+    builds = args
+    if not builds:
+        print >> sys.stderr, __doc__.strip()
+        sys.exit(2)
+
+    if command is None:
+        command = [
+            "--logout", "--host", "http://localhost", "--session-path",
+            os.path.join(tempfile.gettempdir(), "galapi-bench-session")
+        ]
+
+    can_drop_caches = drop_caches()
+    if not can_drop_caches:
+        print "Cannot empty the file cache (run as root), skipping cold runs."
+
+    print "%-30s %12s %12s" % ("build", "cold (ms)", "warm (ms)")
+    for build in builds:
+        cold = None
+        if can_drop_caches:
+            cold_times = []
+            for _ in xrange(max(1, runs // 4)):
+                drop_caches()
+                cold_times.append(run_build(build, command))
+            cold = median(cold_times)
+
+        # Warm up the file cache before the warm runs.
+        run_build(build, command)
+        warm = median(run_build(build, command) for _ in xrange(runs))
+
+        print "%-30s %12s %12.1f" % (
+            os.path.basename(build),
+            "-" if cold is None else "%.1f" % (cold, ), warm
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""
+Measures how long the API client takes to start up, and fails if it takes
+longer than the budget below.
+
+Two things are measured:
+
+* The wall time of ``galapi --logout``, which doesn't need to talk to the
+  server, and, if one is given, of a command run with a cached session.
+* How long each module takes to import, reported in the style of Python 3's
+  ``python -X importtime``: the time spent importing each module itself and
+  including everything it imported.
+
+Usage::
+
+    bench_startup.py [--runs N] [--imports] [-- COMMAND...]
+
+``COMMAND`` is run with the user's normal configuration and session, so it
+should be something harmless like ``whoami``.
+
+"""
+
+import os
+import sys
+import time
+import tempfile
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+#: The most each measurement may take, in milliseconds. When these were set,
+#: a development machine measured 37ms and 190ms (and 53ms and 402ms before
+#: imports were made lazy), so only a real regression, such as an eager
+#: import of a large library, should trip them.
+BUDGET = {
+    "logout": 75,
+    "command": 300
+}
+
+def run_client(args):
+    """
+    Runs the API client and returns how long it took in milliseconds. Exits
+    if the client fails, as a client that crashes straight away would
+    otherwise look fast.
+
+    """
+
+    with open(os.devnull, "w") as devnull:
+        start = time.time()
+        status = subprocess.call(
+            [sys.executable, "-m", "apiclient.main"] + args, cwd = ROOT,
+            stdout = devnull, stderr = devnull
+        )
+        elapsed = (time.time() - start) * 1000
+
+    if status != 0:
+        print >> sys.stderr, "galapi %s exited with status %d." % (
+            " ".join(args), status
+        )
+        sys.exit(1)
+
+    return elapsed
+
+def measure(args, runs):
+    """
+    Returns the median wall time of running the API client ``runs`` times.
+
+    """
+
+    # Warm up the OS's file cache first.
+    run_client(args)
+
+    times = sorted(run_client(args) for _ in xrange(runs))
+    return times[len(times) // 2]
+
+def report_imports(args):
+    """
+    Runs the API client in this process while timing every import, and prints
+    a report to standard error.
+
+    """
+
+    import __builtin__
+
+    real_import = __builtin__.__import__
+
+    # Each entry is [name, self time, cumulative time, depth].
+    entries = []
+    stack = []
+
+    def timed_import(name, *rest, **kwargs):
+        # Relative imports make it hard to tell from the name alone whether
+        # a module is already loaded, so look for new modules instead.
+        loaded_before = len(sys.modules)
+
+        entry = [name, 0.0, 0.0, len(stack)]
+        stack.append(0.0)
+        start = time.time()
+        try:
+            return real_import(name, *rest, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+
+            if len(sys.modules) > loaded_before:
+                entry[1] = elapsed - children
+                entry[2] = elapsed
+                entries.append(entry)
+
+    sys.path.insert(0, ROOT)
+    sys.argv = ["galapi"] + args
+
+    __builtin__.__import__ = timed_import
+    try:
+        import apiclient.main
+        try:
+            apiclient.main.main()
+        except SystemExit:
+            pass
+    finally:
+        __builtin__.__import__ = real_import
+
+    print >> sys.stderr, "import time: self [us] | cumulative | imported package"
+    for name, self_time, cumulative, depth in reversed(entries):
+        print >> sys.stderr, "import time: %9d | %10d | %s%s" % (
+            self_time * 1e6, cumulative * 1e6, "  " * depth, name
+        )
+
+def main():
+    args = sys.argv[1:]
+
+    command = []
+    if "--" in args:
+        command = args[args.index("--") + 1:]
+        args = args[:args.index("--")]
+
+    runs = 11
+    if "--runs" in args:
+        runs = int(args[args.index("--runs") + 1])
+
+    # Point the session at a file that doesn't exist so --logout doesn't log
+    # anyone out.
+    session_path = os.path.join(tempfile.gettempdir(), "galapi-bench-session")
+    logout_args = [
+        "--logout", "--host", "http://localhost",
+        "--session-path", session_path
+    ]
+
+    if "--imports" in args:
+        report_imports(command or logout_args)
+        return
+
+    results = [("logout", measure(logout_args, runs))]
+    if command:
+        results.append(("command", measure(command, runs)))
+
+    over_budget = False
+    for name, elapsed in results:
+        status = "ok"
+        if elapsed > BUDGET[name]:
+            status = "OVER BUDGET"
+            over_budget = True
+
+        print "%-8s %7.1f ms (budget %d ms) %s" % (
+            name, elapsed, BUDGET[name], status
+        )
+
+    sys.exit(1 if over_budget else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""
+Builds ``galapi.pyz``, a single executable file containing the API client and
+the libraries it needs, meant to start up faster than the superzip built by
+``superzip.sh``.
+
+The differences from the superzip are:
+
+* Every module is compiled ahead of time and only the bytecode is stored, so
+  nothing has to be compiled when the client starts. Python imports the
+  bytecode straight out of the archive.
+* Only the libraries the client actually uses are included, rather than a
+  whole virtualenv (with pip, setuptools and so on).
+* PyYAML's C extension is left out, as extension modules can't be imported
+  from an archive. The client only parses its configuration file when the file
+  has changed, so this doesn't matter much.
+
+The libraries are taken from the Python running this script, which should be
+the same version of Python that will run the archive, as bytecode isn't
+portable between versions. The easiest way to get the same libraries the
+superzip uses is to run this from a virtualenv the client was installed into:
+
+.. code-block:: shell-session
+
+    $ virtualenv build-env
+    $ build-env/bin/pip install PyYAML .
+    $ build-env/bin/python scripts/build_zipapp.py galapi.pyz
+
+Usage: build_zipapp.py [OUTPUT]
+
+"""
+
+import os
+import sys
+import stat
+import time
+import marshal
+import zipfile
+import imp
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+#: The top-level packages and modules to include, and whether the client can
+#: run without them.
+PACKAGES = [
+    ("apiclient", False),
+    ("requests", False),
+    ("yaml", False),
+
+    # Older versions of requests (such as the one rauth depends on) bundle
+    # these rather than depending on them.
+    ("urllib3", True),
+    ("chardet", True),
+    ("idna", True),
+    ("certifi", True),
+
+    # Only needed for OAuth.
+    ("rauth", True)
+]
+
+#: Directories that are never included.
+EXCLUDED_DIRECTORIES = set(["tests", "test", "testing", "docs"])
+
+#: File extensions that are never included.
+EXCLUDED_EXTENSIONS = set([".pyc", ".pyo", ".so", ".pyd", ".c", ".h"])
+
+MAIN = """\
+import apiclient.main
+apiclient.main.main()
+"""
+
+def find_package(name):
+    """
+    Returns the path of a top-level package or module, or ``None`` if it isn't
+    installed.
+
+    """
+
+    search_path = [ROOT] + sys.path if name == "apiclient" else sys.path
+
+    try:
+        f, path, _ = imp.find_module(name, search_path)
+    except ImportError:
+        return None
+
+    if f is not None:
+        f.close()
+
+    return path
+
+def compile_source(path, archive_path):
+    """
+    Compiles a Python source file and returns the contents of the ``.pyc`` file
+    that Python would write for it.
+
+    """
+
+    with open(path, "rU") as f:
+        source = f.read()
+
+    if source and not source.endswith("\n"):
+        source += "\n"
+
+    code = compile(source, archive_path, "exec")
+    mtime = int(os.stat(path).st_mtime)
+
+    return imp.get_magic() + marshal.dumps(mtime)[1:] + marshal.dumps(code)
+
+def add_file(archive, path, archive_path):
+    """
+    Adds a file to the archive, compiling it first if it's Python source.
+
+    :returns: The number of bytes added.
+
+    """
+
+    extension = os.path.splitext(path)[1]
+    if extension in EXCLUDED_EXTENSIONS:
+        return 0
+
+    if extension == ".py":
+        data = compile_source(path, archive_path)
+        archive_path += "c"
+    else:
+        with open(path, "rb") as f:
+            data = f.read()
+
+    info = zipfile.ZipInfo(archive_path, time.localtime()[:6])
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = (stat.S_IFREG | 0o644) << 16
+    archive.writestr(info, data)
+
+    return len(data)
+
+def add_package(archive, path):
+    """
+    Adds a package (or single module) to the archive.
+
+    """
+
+    if os.path.isfile(path):
+        return add_file(archive, path, os.path.basename(path))
+
+    base = os.path.dirname(path)
+    total = 0
+    for dir_path, dir_names, file_names in os.walk(path):
+        dir_names[:] = sorted(
+            i for i in dir_names
+                if i not in EXCLUDED_DIRECTORIES and not i.startswith(".")
+        )
+
+        for i in sorted(file_names):
+            full_path = os.path.join(dir_path, i)
+            total += add_file(
+                archive, full_path, os.path.relpath(full_path, base)
+            )
+
+    return total
+
+def main():
+    output = sys.argv[1] if len(sys.argv) > 1 else "galapi.pyz"
+    temp_output = output + ".tmp"
+
+    with open(temp_output, "wb") as f:
+        # The bytecode only works with this version of Python, so make sure
+        # the archive is run with it.
+        f.write("#!/usr/bin/env python%d.%d\n" % sys.version_info[:2])
+
+    archive = zipfile.ZipFile(temp_output, "a", zipfile.ZIP_DEFLATED)
+    try:
+        for name, optional in PACKAGES:
+            path = find_package(name)
+            if path is None:
+                if optional:
+                    print "Skipping %s, which isn't installed." % (name, )
+                    continue
+
+                print >> sys.stderr, "%s is not installed." % (name, )
+                sys.exit(1)
+
+            print "Adding %s from %s (%d bytes)." % (
+                name, path, add_package(archive, path)
+            )
+
+        archive.writestr("__main__.py", MAIN)
+    finally:
+        archive.close()
+
+    os.chmod(temp_output, 0o755)
+    os.rename(temp_output, output)
+
+    print "Built %s (%d bytes)." % (output, os.path.getsize(output))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+"""
+Checks that identical, concurrent calls to a command listed in
+coalesce-commands share one request, against a local stand-in server.
+
+Two cases are checked:
+
+* The first call succeeds. Only one request should reach the server, and every
+  caller should print its response.
+* The first call fails. Every caller that waited on it should then send its own
+  request and print that response instead.
+
+Exits with a non-zero status if either check fails.
+
+Usage: check_coalesce.py [CALLERS]
+
+"""
+
+import os
+import sys
+import time
+import StringIO
+import threading
+import SocketServer
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "apiclient"))
+
+import lib.config as config
+import lib.communicate as communicate
+import lib.ui as ui
+import lib.logcontrol as logcontrol
+
+#: The body the stand-in server responds to every successful call with.
+BODY = "jsull@galah.edu (student)"
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        with self.server.lock:
+            self.server.calls += 1
+            first = self.server.calls == 1
+
+        if first:
+            # Hold the first call until every caller has had a chance to
+            # start waiting on it.
+            self.server.received.set()
+            self.server.release.wait()
+
+        if first and self.server.fail_first:
+            body = "Something went wrong."
+            headers = {"X-CallSuccess": "False", "X-ErrorType": "Error"}
+        else:
+            body = BODY
+            headers = {"X-CallSuccess": "True"}
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def run_callers(session, server, callers):
+    """
+    Makes ``callers`` identical calls at once, the first of which reaches the
+    server before the rest start.
+
+    :returns: A list of ``(exit_status, output)`` tuples, the first caller's
+            first.
+
+    """
+
+    results = [None] * callers
+
+    def caller(index):
+        out = StringIO.StringIO()
+        exit_status, _ = ui.run_redirected(
+            lambda: session.call("find_user", "jsull@galah.edu"),
+            out, StringIO.StringIO()
+        )
+        results[index] = (exit_status, out.getvalue())
+
+    threads = [
+        threading.Thread(target = caller, args = (i, ))
+            for i in xrange(callers)
+    ]
+
+    threads[0].start()
+    server.received.wait(10)
+    for i in threads[1:]:
+        i.start()
+
+    # There's no way to see the callers start waiting, so give them plenty
+    # of time to.
+    time.sleep(0.5)
+    server.release.set()
+
+    for i in threads:
+        i.join()
+
+    return results
+
+def check(name, server, results, expected_calls, expected_failures):
+    failures = [i for i in results if i[0] != 0]
+    outputs = set(i[1].strip() for i in results if i[0] == 0)
+
+    problems = []
+    if server.calls != expected_calls:
+        problems.append("%d requests reached the server, expected %d" %
+            (server.calls, expected_calls))
+    if len(failures) != expected_failures:
+        problems.append("%d calls failed, expected %d" %
+            (len(failures), expected_failures))
+    if outputs != set([BODY]):
+        problems.append("successful calls printed %r" % (sorted(outputs), ))
+
+    print "%-14s %s" % (name, "; ".join(problems) or "ok")
+    return not problems
+
+def main():
+    callers = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+
+    # Each caller's log messages are captured and thrown away.
+    logcontrol.init_logging()
+
+    config.CONFIG = dict(
+        (i.name, i.default_value)
+            for i in config.KNOWN_OPTIONS.values()
+            if i.default_value is not None
+    )
+    config.CONFIG["coalesce-commands"] = "find_user"
+    config.CONFIG["no-cache"] = True
+    config.CONFIG["no-verify-certificate"] = True
+
+    api_info = communicate._parse_api_info([
+        {"name": "find_user", "args": [{"name": "email"}]}
+    ])
+
+    succeeded = True
+    for name, fail_first, expected_calls, expected_failures in (
+            ("leader ok", False, 1, 0),
+            ("leader failed", True, callers, 1)):
+        server = Server(("127.0.0.1", 0), Handler)
+        server.calls = 0
+        server.fail_first = fail_first
+        server.lock = threading.Lock()
+        server.received = threading.Event()
+        server.release = threading.Event()
+        thread = threading.Thread(target = server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        config.CONFIG["host"] = "http://127.0.0.1:%d" % (server.server_port, )
+        session = communicate.APIClientSession(
+            user = "jsull@galah.edu", api_info = api_info
+        )
+
+        try:
+            results = run_callers(session, server, callers)
+            succeeded &= check(
+                name, server, results, expected_calls, expected_failures
+            )
+        finally:
+            session.requests_session.close()
+            server.shutdown()
+
+    sys.exit(0 if succeeded else 1)
+
+if __name__ == "__main__":
+    main()